@@ -0,0 +1,658 @@
+import os
+import argparse
+import time
+import torch
+from torch.nn import functional as F
+import torch.multiprocessing as mp
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.cuda.amp import GradScaler
+
+import utils
+import commons
+from data_utils import TextAudioSpeakerCollate
+from losses import SpectralLoss, stft_loss, discriminator_loss, generator_loss, feature_loss
+from mel_processing import MelFrontend, mel_spectrogram_torch, spectrogram_torch
+from models import SynthesizerTrn, MultiPeriodDiscriminator, compile_generator
+
+
+def timeit(fn, n_iters, warmup=3):
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    return (time.perf_counter() - start) / n_iters
+
+
+def fake_batch(hps, batch_size, min_frames=50, max_frames=600):
+    """Random (c, spec, wav, spk) items shaped like TextAudioSpeakerLoader outputs."""
+    batch = []
+    for _ in range(batch_size):
+        frames = int(torch.randint(min_frames, max_frames, (1,)))
+        c = torch.randn(hps.model.ssl_dim, frames - 1)
+        spec = torch.rand(hps.data.filter_length // 2 + 1, frames)
+        wav = torch.rand(1, frames * hps.data.hop_length) * 2 - 1
+        spk = torch.randn(hps.model.gin_channels)
+        batch.append((c, spec, wav, spk))
+    return batch
+
+
+def bench_collate(hps, args):
+    batch = fake_batch(hps, args.batch_size)
+    padded = TextAudioSpeakerCollate(hps, crop=False)
+    cropped = TextAudioSpeakerCollate(hps, crop=True)
+
+    for name, collate in [("padded", padded), ("cropped", cropped)]:
+        t = timeit(lambda: collate(batch), args.iters)
+        shapes = [tuple(x.shape) for x in collate(batch)]
+        print(f"{name:>8}: {t * 1000:8.2f} ms/batch  {shapes}")
+
+
+def bench_spectral_loss(hps, args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    frames = hps.train.segment_size // hps.data.hop_length
+    n_freqs = hps.data.filter_length // 2 + 1
+    y = torch.rand(args.batch_size, 1, hps.train.segment_size, device=device) * 2 - 1
+    y_hat = torch.rand(args.batch_size, 1, hps.train.segment_size, device=device) * 2 - 1
+    y_spec = torch.rand(args.batch_size, n_freqs, frames, device=device) + 1e-3
+    mel_frontend = MelFrontend.from_hparams(hps.data).to(device)
+    y_mel = mel_frontend.spec_to_mel(y_spec)
+    resolutions = [(512, 128, 512), (2048, 512, 2048)]
+
+    def sync(fn):
+        def wrapped():
+            fn()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+        return wrapped
+
+    def mel_spectrogram_step():
+        # previous per-step path: a separate mel_spectrogram_torch call on y_hat
+        y_hat_mel = mel_spectrogram_torch(y_hat.squeeze(1), hps.data.filter_length, hps.data.n_mel_channels,
+            hps.data.sampling_rate, hps.data.hop_length, hps.data.win_length, hps.data.mel_fmin, hps.data.mel_fmax)
+        return F.l1_loss(y_mel, y_hat_mel)
+
+    def naive_multi_resolution_step():
+        # what an independent STFT loss would cost: fresh STFTs of y and y_hat at every resolution
+        loss = mel_spectrogram_step()
+        for n_fft, hop_size, win_size in [(hps.data.filter_length, hps.data.hop_length, hps.data.win_length)] + resolutions:
+            spec_r = spectrogram_torch(y.squeeze(1), n_fft, hps.data.sampling_rate, hop_size, win_size)
+            spec_g = spectrogram_torch(y_hat.squeeze(1), n_fft, hps.data.sampling_rate, hop_size, win_size)
+            loss = loss + stft_loss(spec_r, spec_g)
+        return loss
+
+    spectral_loss = SpectralLoss(mel_frontend).to(device)
+    spectral_loss_mr = SpectralLoss(mel_frontend, resolutions).to(device)
+    cases = [
+        ("mel_spectrogram_torch", mel_spectrogram_step),
+        ("SpectralLoss", lambda: spectral_loss(y_hat, y_mel)),
+        ("naive multi-res", naive_multi_resolution_step),
+        ("SpectralLoss multi-res", lambda: spectral_loss_mr(y_hat, y_mel, y_spec, y)),
+    ]
+    for name, fn in cases:
+        t = timeit(sync(fn), args.iters)
+        print(f"{name:>24}: {t * 1000:8.2f} ms/step")
+
+
+def build_training(hps, device, freeze_g=(), freeze_d=()):
+    net_g = SynthesizerTrn(
+        hps.data.filter_length // 2 + 1,
+        hps.train.segment_size // hps.data.hop_length,
+        **hps.model).to(device)
+    net_d = MultiPeriodDiscriminator(hps.model.use_spectral_norm).to(device)
+    commons.freeze_parameters(net_g, freeze_g)
+    commons.freeze_parameters(net_d, freeze_d)
+    spectral_loss = SpectralLoss(MelFrontend.from_hparams(hps.data)).to(device)
+    optim_g = torch.optim.AdamW([p for p in net_g.parameters() if p.requires_grad],
+                                hps.train.learning_rate, betas=hps.train.betas, eps=hps.train.eps)
+    optim_d = torch.optim.AdamW([p for p in net_d.parameters() if p.requires_grad],
+                                hps.train.learning_rate, betas=hps.train.betas, eps=hps.train.eps)
+    return [net_g, net_d], [optim_g, optim_d], spectral_loss
+
+
+def optimizer_state_bytes(optim):
+    return sum(v.numel() * v.element_size() for state in optim.state.values() for v in state.values()
+               if torch.is_tensor(v))
+
+
+def ddp_worker(rank, world_size, hps, args, results):
+    import train
+
+    device = train.get_device(rank, hps)
+    backend = "nccl" if device.type == "cuda" else "gloo"
+    dist.init_process_group(backend=backend, init_method="env://", world_size=world_size, rank=rank)
+    if device.type == "cuda":
+        torch.cuda.set_device(rank)
+    else:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    torch.manual_seed(hps.train.seed)
+
+    nets, optims, spectral_loss = build_training(hps, device)
+    device_ids = [rank] if device.type == "cuda" else None
+    nets = [DDP(net, device_ids=device_ids) for net in nets]
+    scaler = GradScaler(enabled=hps.train.fp16_run and device.type == "cuda")
+    items = TextAudioSpeakerCollate(hps)(fake_batch(hps, args.batch_size, min_frames=60, max_frames=200))
+
+    def step():
+        train.train_step(rank, hps, nets, optims, scaler, spectral_loss, items)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+    t = timeit(step, args.iters, warmup=1)
+    if rank == 0:
+        results[world_size] = 1. / t
+    dist.destroy_process_group()
+
+
+def bench_ddp(hps, args):
+    os.environ["MASTER_ADDR"] = "localhost"
+    os.environ["MASTER_PORT"] = hps.train.port
+    results = mp.Manager().dict()
+    for world_size in args.world_sizes:
+        mp.spawn(ddp_worker, nprocs=world_size, args=(world_size, hps, args, results))
+        steps_per_sec = results[world_size]
+        print(f"world_size {world_size}: {steps_per_sec:6.3f} steps/s  "
+              f"{steps_per_sec * world_size * args.batch_size:7.2f} samples/s  "
+              f"scaling {steps_per_sec * world_size / (results[args.world_sizes[0]] * args.world_sizes[0]):.2f}x")
+
+
+def bench_train_step(hps, args):
+    import train
+
+    if args.device is not None:
+        hps.train.device = args.device
+    device = train.get_device(0, hps)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    nets, optims, spectral_loss = build_training(hps, device)
+    scaler = GradScaler(enabled=hps.train.fp16_run and device.type == "cuda")
+    items = TextAudioSpeakerCollate(hps)(fake_batch(hps, args.batch_size))
+
+    if device.type == "cuda":
+        precisions = [("fp32", False), ("fp16", True)]
+    else:
+        precisions = [("fp32", False), ("bf16", True)] if train.cpu_bf16_supported() else [("fp32", False)]
+    print(f"device {device}, {torch.get_num_threads()} threads, batch {args.batch_size}, "
+          f"{items[1].size(-1)} frames per item")
+    for name, mixed in precisions:
+        hps.train.fp16_run = mixed and device.type == "cuda"
+        hps.train.bf16_run = mixed and device.type == "cpu"
+
+        def step():
+            train.train_step(0, hps, nets, optims, scaler, spectral_loss, items)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+
+        t = timeit(step, args.iters, warmup=1)
+        print(f"{name}: {t:6.2f} s/step  {3600. / t:8.0f} steps/hour")
+
+
+def bench_freeze(hps, args):
+    import train
+
+    device = train.get_device(0, hps)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    items = TextAudioSpeakerCollate(hps)(fake_batch(hps, args.batch_size))
+    cases = [("full", [], [], False), ("frozen", args.freeze, args.freeze_d, False)]
+    if "enc_p" in args.freeze:
+        cases.append(("frozen + enc_p cache", args.freeze, args.freeze_d, True))
+
+    print(f"device {device}, batch {args.batch_size}, freeze G {args.freeze}, freeze D {args.freeze_d}")
+    for name, freeze_g, freeze_d, cache_enc_p in cases:
+        torch.manual_seed(1234)
+        nets, optims, spectral_loss = build_training(hps, device, freeze_g, freeze_d)
+        hps.train.cache_enc_p = cache_enc_p
+        case_items = items
+        if cache_enc_p:
+            # what build_enc_p_cache stores: [m_p; logs_p] of the frozen enc_p
+            c = items[0].to(device)
+            with torch.no_grad():
+                _, m_p, logs_p, _ = nets[0].enc_p(c, torch.LongTensor([c.size(-1)] * c.size(0)).to(device))
+            case_items = (torch.cat([m_p, logs_p], 1).cpu(),) + tuple(items[1:])
+
+        def step():
+            train.train_step(0, hps, nets, optims, scaler, spectral_loss, case_items)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+
+        scaler = GradScaler(enabled=hps.train.fp16_run and device.type == "cuda")
+        t = timeit(step, args.iters, warmup=1)
+        n_trainable = sum(p.numel() for net in nets for p in net.parameters() if p.requires_grad)
+        state_mb = sum(optimizer_state_bytes(optim) for optim in optims) / 2 ** 20
+        print(f"{name:>22}: {1. / t:6.3f} steps/s  {n_trainable / 1e6:7.2f}M trainable  "
+              f"{state_mb:8.1f} MB optimizer state")
+
+
+def bench_grad_norm(hps, args):
+    import train
+
+    device = train.get_device(0, hps)
+    nets, optims, spectral_loss = build_training(hps, device)
+    scaler = GradScaler(enabled=hps.train.fp16_run and device.type == "cuda")
+    items = TextAudioSpeakerCollate(hps)(fake_batch(hps, args.batch_size, min_frames=60, max_frames=200))
+    train.train_step(0, hps, nets, optims, scaler, spectral_loss, items)
+
+    def item_loop(parameters):
+        # previous clip_grad_value_(parameters, None): one norm and one host sync per parameter
+        total_norm = 0
+        for p in parameters:
+            if p.grad is not None:
+                total_norm += p.grad.data.norm(2).item() ** 2
+        return total_norm ** 0.5
+
+    def sync(fn):
+        def wrapped():
+            fn()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+        return wrapped
+
+    print(f"device {device}, foreach norm: {hasattr(torch, '_foreach_norm')}")
+    for net, name in zip(nets, ["G", "D"]):
+        n_params = sum(1 for p in net.parameters() if p.grad is not None)
+        t_loop = timeit(sync(lambda: item_loop(net.parameters())), args.iters)
+        t_fused = timeit(sync(lambda: commons.grad_norm(net.parameters())), args.iters)
+        t_log = timeit(sync(lambda: commons.grad_norm(net.parameters()).item()), args.iters)
+        diff = abs(item_loop(net.parameters()) - commons.grad_norm(net.parameters()).item())
+        print(f"{name} ({n_params} grads): per-parameter .item() {t_loop * 1000:7.2f} ms  "
+              f"fused {t_fused * 1000:7.2f} ms  fused + .item() {t_log * 1000:7.2f} ms  |diff| {diff:.2e}")
+
+
+def bench_discriminator(hps, args):
+    import train
+
+    device = train.get_device(0, hps)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    nets, optims, spectral_loss = build_training(hps, device)
+    net_d = nets[1]
+    scaler = GradScaler(enabled=hps.train.fp16_run and device.type == "cuda")
+    items = TextAudioSpeakerCollate(hps)(fake_batch(hps, args.batch_size))
+
+    y = torch.rand(args.batch_size, 1, hps.train.segment_size, device=device) * 2 - 1
+    y_hat = torch.rand(args.batch_size, 1, hps.train.segment_size, device=device) * 2 - 1
+    with torch.no_grad():
+        net_d.fused_forward = False
+        separate = net_d(y, y_hat)
+        net_d.fused_forward = True
+        fused = net_d(y, y_hat)
+    diff = max((a - b).abs().max().item() for xs, ys in zip(separate, fused) for x, y_ in zip(xs, ys)
+               for a, b in (zip(x, y_) if isinstance(x, list) else [(x, y_)]))
+    print(f"device {device}, batch {args.batch_size}, max |fused - separate| {diff:.2e}")
+
+    for fused_forward in [False, True]:
+        net_d.fused_forward = fused_forward
+
+        def step():
+            train.train_step(0, hps, nets, optims, scaler, spectral_loss, items)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+
+        def forward():
+            with torch.no_grad():
+                net_d(y, y_hat)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+
+        t_forward = timeit(forward, args.iters)
+        t_step = timeit(step, args.iters, warmup=1)
+        print(f"fused_forward {str(fused_forward):>5}: {t_forward * 1000:8.1f} ms/D forward  {t_step:6.2f} s/step")
+
+
+def bench_losses(hps, args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    net_d = MultiPeriodDiscriminator(hps.model.use_spectral_norm).to(device)
+    y = torch.rand(args.batch_size, 1, hps.train.segment_size, device=device) * 2 - 1
+    y_hat = (torch.rand(args.batch_size, 1, hps.train.segment_size, device=device) * 2 - 1).requires_grad_()
+    y_d_hat_r, y_d_hat_g, fmap_r, fmap_g = net_d(y, y_hat)
+
+    def previous_losses():
+        # the per-discriminator Python loops with an .item() per discriminator
+        loss_disc, r_losses, g_losses = 0, [], []
+        for dr, dg in zip(y_d_hat_r, y_d_hat_g):
+            r_loss = torch.mean((1-dr.float())**2)
+            g_loss = torch.mean(dg.float()**2)
+            loss_disc += (r_loss + g_loss)
+            r_losses.append(r_loss.item())
+            g_losses.append(g_loss.item())
+        loss_fm = 0
+        for dr, dg in zip(fmap_r, fmap_g):
+            for rl, gl in zip(dr, dg):
+                loss_fm += torch.mean(torch.abs(rl.float().detach() - gl.float()))
+        loss_gen, gen_losses = 0, []
+        for dg in y_d_hat_g:
+            l = torch.mean((1-dg.float())**2)
+            gen_losses.append(l)
+            loss_gen += l
+        return loss_disc, loss_fm * 2, loss_gen
+
+    def current_losses():
+        loss_disc, _, _ = discriminator_loss(y_d_hat_r, y_d_hat_g)
+        loss_fm = feature_loss(fmap_r, fmap_g)
+        loss_gen, _ = generator_loss(y_d_hat_g)
+        return loss_disc, loss_fm, loss_gen
+
+    def sync(fn):
+        def wrapped():
+            fn()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+        return wrapped
+
+    diff = max(abs(a.item() - b.item()) for a, b in zip(previous_losses(), current_losses()))
+    t_previous = timeit(sync(previous_losses), args.iters)
+    t_current = timeit(sync(current_losses), args.iters)
+    print(f"device {device}, batch {args.batch_size}: loops + .item() {t_previous * 1000:7.2f} ms/step  "
+          f"stacked {t_current * 1000:7.2f} ms/step  max |diff| {diff:.2e}")
+
+
+def bench_compile(hps, args):
+    import train
+
+    device = train.get_device(0, hps)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    scaler = GradScaler(enabled=hps.train.fp16_run and device.type == "cuda")
+    items = TextAudioSpeakerCollate(hps)(fake_batch(hps, args.batch_size))
+    c = torch.randn(1, hps.model.ssl_dim, 250, device=device)
+    g = torch.randn(1, hps.model.gin_channels, device=device)
+
+    def sync(fn):
+        def wrapped():
+            fn()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+        return wrapped
+
+    print(f"device {device}, batch {args.batch_size}, infer on {c.size(-1)} frames")
+    for compiled in [False, True]:
+        torch.manual_seed(1234)
+        nets, optims, spectral_loss = build_training(hps, device)
+        if compiled:
+            compile_generator(nets[0])
+        step = sync(lambda: train.train_step(0, hps, nets, optims, scaler, spectral_loss, items))
+
+        def infer():
+            nets[0].eval()
+            with torch.no_grad():
+                nets[0].infer(c, g=g)
+            nets[0].train()
+
+        # the first call of each path includes compilation
+        t_first_step = timeit(step, 1, warmup=0)
+        t_first_infer = timeit(sync(infer), 1, warmup=0)
+        t_step = timeit(step, args.iters, warmup=1)
+        t_infer = timeit(sync(infer), args.iters, warmup=1)
+        print(f"{'compiled' if compiled else 'eager':>8}: first step {t_first_step:7.2f} s  steady {t_step:6.2f} s/step  "
+              f"first infer {t_first_infer:7.2f} s  steady {t_infer * 1000:8.1f} ms/infer")
+
+
+class SavedActivations:
+    """Tracks the peak size of the tensors autograd keeps for the backward pass."""
+
+    def __init__(self):
+        self.live, self.current, self.peak = {}, 0, 0
+
+    def pack(self, x):
+        key = (x.data_ptr(), x.numel(), x.dtype)
+        count, size = self.live.get(key, (0, x.numel() * x.element_size()))
+        if count == 0:
+            self.current += size
+            self.peak = max(self.peak, self.current)
+        self.live[key] = (count + 1, size)
+        return SavedTensor(self, key, x)
+
+    def release(self, key):
+        count, size = self.live[key]
+        if count == 1:
+            del self.live[key]
+            self.current -= size
+        else:
+            self.live[key] = (count - 1, size)
+
+
+class SavedTensor:
+    def __init__(self, tracker, key, x):
+        self.tracker, self.key, self.x = tracker, key, x
+
+    def __del__(self):
+        self.tracker.release(self.key)
+
+
+def bench_memory(hps, args):
+    import train
+
+    device = train.get_device(0, hps)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    items = TextAudioSpeakerCollate(hps)(fake_batch(hps, args.batch_size))
+    print(f"device {device}, batch {args.batch_size}, {items[1].size(-1)} frames per item")
+    for grad_checkpoint in [False, True]:
+        for accum_steps in [1, args.accum_steps]:
+            torch.manual_seed(1234)
+            nets, optims, spectral_loss = build_training(hps, device)
+            commons.set_gradient_checkpointing(nets[0], grad_checkpoint)
+            hps.train.grad_accum_steps = accum_steps
+            scaler = GradScaler(enabled=hps.train.fp16_run and device.type == "cuda")
+            saved = SavedActivations()
+
+            def step():
+                with torch.autograd.graph.saved_tensors_hooks(saved.pack, lambda s: s.x):
+                    train.train_step(0, hps, nets, optims, scaler, spectral_loss, items)
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+
+            if device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(device)
+            t = timeit(step, args.iters, warmup=1)
+            report = f"checkpoint {str(grad_checkpoint):>5}, accum {accum_steps}: {t:6.2f} s/step  " \
+                     f"{saved.peak / 2 ** 20:8.1f} MB peak saved activations"
+            if device.type == "cuda":
+                report += f"  {torch.cuda.max_memory_allocated(device) / 2 ** 20:8.1f} MB peak allocated"
+            print(report)
+
+
+def bench_resample(hps, args):
+    import librosa
+    import numpy as np
+    from resample import resample
+
+    device = torch.device(args.device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    rng = np.random.default_rng(1234)
+    for orig_sr, target_sr in [(22050, 16000), (48000, 16000), (48000, 22050), (16000, 22050)]:
+        # 3 s sums of sines below 85% of the lower Nyquist frequency: the transition bands of the
+        # two filters differ, the pass band (where speech is) should not
+        t = np.arange(3 * orig_sr) / orig_sr
+        freqs = rng.uniform(50, 0.85 * min(orig_sr, target_sr) / 2, (args.batch_size, 20, 1))
+        phases = rng.uniform(0, 2 * np.pi, (args.batch_size, 20, 1))
+        wavs = (np.sin(2 * np.pi * freqs * t + phases).sum(1) / 20).astype(np.float32)
+        x = torch.from_numpy(wavs).to(device)
+
+        def torch_batch():
+            resample(x, orig_sr, target_sr)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+
+        t_librosa = timeit(lambda: [librosa.resample(w, orig_sr=orig_sr, target_sr=target_sr, res_type="soxr_hq") for w in wavs], max(1, args.iters // 10), warmup=1)
+        t_torch = timeit(torch_batch, args.iters)
+        ref = np.stack([librosa.resample(w, orig_sr=orig_sr, target_sr=target_sr, res_type="soxr_hq") for w in wavs])
+        out = resample(x, orig_sr, target_sr).cpu().numpy()
+        # the first and last 50 ms are edge effects of the two filters' different lengths
+        edge = target_sr // 20
+        diff = np.abs(out - ref)[:, edge:-edge].max()
+        print(f"{orig_sr:>5} -> {target_sr:>5} ({args.batch_size} x 3 s): librosa {t_librosa * 1000:8.2f} ms  "
+              f"torch ({device}) {t_torch * 1000:8.2f} ms  max |diff| {diff:.2e}  shapes {out.shape} {ref.shape}")
+        # parity with librosa.load (soxr_hq): same length, and 1e-3 is -60 dB of full scale
+        assert out.shape == ref.shape, f"{orig_sr} -> {target_sr}: shape {out.shape}, librosa {ref.shape}"
+        assert diff < 1e-3, f"{orig_sr} -> {target_sr}: max |diff| {diff:.2e} against librosa"
+
+
+def bench_sr_augment(hps, args):
+    import json
+    import hifigan
+    from wavlm import WavLM, WavLMConfig
+    from data_utils import SRAugment
+
+    # randomly initialised HiFi-GAN V1 and WavLM-Large: the cost of the stage does not depend on the weights
+    device = torch.device(args.device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    with open("hifigan/config.json", "r") as f:
+        vocoder = hifigan.Generator(hifigan.AttrDict(json.load(f)))
+    vocoder.remove_weight_norm()
+    cmodel = WavLM(WavLMConfig({
+        "extractor_mode": "layer_norm", "encoder_layers": 24, "encoder_embed_dim": 1024,
+        "encoder_ffn_embed_dim": 4096, "encoder_attention_heads": 16, "layer_norm_first": True,
+        "normalize": True, "relative_position_embedding": True, "max_distance": 800, "gru_rel_pos": True}))
+    # the collate crops items to max_speclen frames
+    y = torch.rand(args.batch_size, 1, hps.train.max_speclen * hps.data.hop_length, device=device) * 2 - 1
+
+    # whole batch at once, and one window per vocoder / WavLM call
+    for chunk_seconds in [None, y.size(-1) / hps.data.sampling_rate]:
+        sr_augment = SRAugment(vocoder, cmodel, hps.data.sampling_rate, hps.data.hop_length,
+                               chunk_seconds=chunk_seconds).to(device)
+
+        def step():
+            sr_augment(y)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+
+        t = timeit(step, args.iters, warmup=1)
+        print(f"chunk_seconds {chunk_seconds}: {t * 1000:8.1f} ms/batch "
+              f"({args.batch_size} x {y.size(-1) / hps.data.sampling_rate:.2f} s windows, {device}), "
+              f"c {tuple(sr_augment(y).shape)}")
+
+
+def bench_vad(hps, args):
+    import glob
+    import struct
+    import numpy as np
+    import webrtcvad
+    from resample import load_audio
+    from speaker_encoder import audio
+    from speaker_encoder.params_data import sampling_rate, vad_window_length
+
+    if args.wav_dir:
+        wavs = [load_audio(p, sr=sampling_rate)[0] for p in sorted(glob.glob(os.path.join(args.wav_dir, "**", "*.wav"), recursive=True))[:args.batch_size]]
+    else:
+        # 10 s speech-like signals: harmonic "syllables" (f0 100-250 Hz, ~4 Hz envelope) between
+        # pauses of 0.1-1.5 s over a noise floor 50 dB down
+        rng = np.random.default_rng(1234)
+        wavs = []
+        for _ in range(args.batch_size):
+            wav = rng.standard_normal(10 * sampling_rate) * 10 ** (-50 / 20) * 0.3
+            pos = int(rng.uniform(0.1, 1.5) * sampling_rate)
+            while pos < len(wav):
+                n = int(rng.uniform(0.5, 2.0) * sampling_rate)
+                t = np.arange(min(n, len(wav) - pos)) / sampling_rate
+                f0 = rng.uniform(100, 250) * (1 + 0.1 * np.sin(2 * np.pi * 0.7 * t))
+                phase = 2 * np.pi * np.cumsum(f0) / sampling_rate
+                voiced = sum(np.sin(k * phase) / k for k in range(1, 20))
+                voiced *= np.abs(np.sin(2 * np.pi * rng.uniform(3, 5) * t)) * rng.uniform(0.1, 0.5)
+                wav[pos:pos + len(t)] += voiced
+                pos += n + int(rng.uniform(0.1, 1.5) * sampling_rate)
+            wavs.append(audio.normalize_volume(wav.astype(np.float32), audio.audio_norm_target_dBFS, increase_only=True))
+    samples_per_window = (vad_window_length * sampling_rate) // 1000
+    wavs = [w[:len(w) - len(w) % samples_per_window] for w in wavs]
+    seconds = sum(len(w) for w in wavs) / sampling_rate
+
+    def webrtc_struct(wav):
+        # the previous packing: one Python int per sample through struct.pack, bytes copied per window
+        pcm_wave = struct.pack("%dh" % len(wav), *(np.round(wav * audio.int16_max)).astype(np.int16))
+        vad = webrtcvad.Vad(mode=3)
+        return np.array([vad.is_speech(pcm_wave[s * 2:(s + samples_per_window) * 2], sample_rate=sampling_rate)
+                         for s in range(0, len(wav), samples_per_window)], dtype=bool)
+
+    flags = {}
+    for name, fn in [("webrtc (struct.pack)", webrtc_struct),
+                     ("webrtc (tobytes)", lambda w: audio.webrtc_voice_flags(w, samples_per_window)),
+                     ("energy", lambda w: audio.energy_voice_flags(w, samples_per_window))]:
+        t = timeit(lambda: [fn(w) for w in wavs], args.iters, warmup=1)
+        flags[name] = np.concatenate([fn(w) for w in wavs])
+        print(f"{name:<21} {t * 1000:8.2f} ms for {len(wavs)} wavs ({seconds:.0f} s of audio), {flags[name].mean() * 100:5.1f}% voiced windows")
+    assert (flags["webrtc (struct.pack)"] == flags["webrtc (tobytes)"]).all()
+
+    kept = {vad: np.array([len(audio.trim_long_silences(w, vad)) for w in wavs]) for vad in ["webrtc", "energy"]}
+    print(f"energy vs webrtc: {(flags['energy'] == flags['webrtc (tobytes)']).mean() * 100:.1f}% of windows agree, "
+          f"trimmed lengths {kept['energy'].sum() / sampling_rate:.1f} s vs {kept['webrtc'].sum() / sampling_rate:.1f} s "
+          f"(max per-wav difference {np.abs(kept['energy'] - kept['webrtc']).max() / sampling_rate:.2f} s)")
+
+def bench_speaker_encoder(hps, args):
+    import glob
+    import numpy as np
+    from resample import load_audio
+    from speaker_encoder import audio
+    from speaker_encoder.voice_encoder import SpeakerEncoder
+    from speaker_encoder.params_data import sampling_rate, partials_n_frames
+
+    device = torch.device(args.device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    encoder = SpeakerEncoder(args.spk_encoder_ckpt, device=device, verbose=False)
+    if args.wav_dir:
+        paths = sorted(glob.glob(os.path.join(args.wav_dir, "**", "*.wav"), recursive=True))[:args.batch_size]
+        wavs = [audio.preprocess_wav(load_audio(p, sr=sampling_rate)[0]) for p in paths]
+        # recordings without any voice are trimmed to nothing
+        wavs = [wav for wav in wavs if len(wav) > 0]
+    else:
+        # utterances of 1-8 s; the front end does not care what is in them
+        rng = np.random.default_rng(1234)
+        wavs = [(rng.standard_normal(int(rng.uniform(1, 8) * sampling_rate)) * 0.1).astype(np.float32)
+                for _ in range(args.batch_size)]
+
+    def embed_librosa(wav, rate=1.3, min_coverage=0.75):
+        # the original path: one librosa melspectrogram per utterance and a copy per partial
+        wav_slices, mel_slices = encoder.compute_partial_slices(len(wav), rate, min_coverage)
+        if wav_slices[-1].stop >= len(wav):
+            wav = np.pad(wav, (0, wav_slices[-1].stop - len(wav)), "constant")
+        frames = audio.wav_to_mel_spectrogram(wav)
+        mels = np.array([frames[s] for s in mel_slices])
+        with torch.no_grad():
+            partial_embeds = encoder(torch.from_numpy(mels).to(device)).cpu().numpy()
+        raw_embed = np.mean(partial_embeds, axis=0)
+        return raw_embed / np.linalg.norm(raw_embed, 2)
+
+    def mels_librosa():
+        return [audio.wav_to_mel_spectrogram(wav) for wav in wavs]
+
+    def mels_torch():
+        encoder.mel_spectrograms(wavs)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+    ref = np.stack([embed_librosa(wav) for wav in wavs])
+    out = encoder.embed_utterances(wavs)
+    mel_ref = mels_librosa()
+    with torch.no_grad():
+        mel_out = encoder.mel_spectrograms(wavs)
+    mel_diff = max(np.abs(m - m_out.cpu().numpy()).max() / m.max() for m, m_out in zip(mel_ref, mel_out))
+    print(f"{len(wavs)} utterances ({sum(map(len, wavs)) / sampling_rate:.0f} s, {partials_n_frames}-frame partials), {device}")
+    print(f"mel spectrograms: librosa {timeit(mels_librosa, args.iters, warmup=1) * 1000:8.2f} ms  "
+          f"torch {timeit(mels_torch, args.iters, warmup=1) * 1000:8.2f} ms  max relative |diff| {mel_diff:.2e}")
+    print(f"embeddings:       librosa {timeit(lambda: [embed_librosa(wav) for wav in wavs], args.iters, warmup=1) * 1000:8.2f} ms  "
+          f"torch {timeit(lambda: encoder.embed_utterances(wavs), args.iters, warmup=1) * 1000:8.2f} ms  "
+          f"max |diff| {np.abs(out - ref).max():.2e}  min cosine {(out * ref).sum(1).min():.6f}")
+    # the torch front end must not change the embeddings convert.py and training see
+    assert np.abs(out - ref).max() < 1e-5, f"embeddings: max |diff| {np.abs(out - ref).max():.2e} against the librosa front end"
+    assert (out * ref).sum(1).min() > 0.9999, f"embeddings: min cosine {(out * ref).sum(1).min():.6f} against the librosa front end"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", type=str, choices=["collate", "spectral_loss", "ddp", "train_step", "freeze", "memory", "grad_norm", "discriminator", "losses", "compile", "resample", "sr_augment", "vad", "speaker_encoder"], help="what to benchmark")
+    parser.add_argument("-c", "--config", type=str, default="configs/freevc.json", help="path to json config file")
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--device", type=str, default=None, help="overrides hps.train.device for train_step (and the device of resample, sr_augment and speaker_encoder)")
+    parser.add_argument("--num_threads", type=int, default=None, help="torch intra-op threads for train_step")
+    parser.add_argument("--world_sizes", type=int, nargs="+", default=[1, 2], help="process counts for the ddp benchmark")
+    parser.add_argument("--freeze", type=str, nargs="*", default=["enc_p", "flow.flows.0", "flow.flows.2"],
+                        help="generator parameter prefixes frozen by the freeze benchmark")
+    parser.add_argument("--freeze_d", type=str, nargs="*", default=[],
+                        help="discriminator parameter prefixes frozen by the freeze benchmark")
+    parser.add_argument("--wav_dir", type=str, default=None, help="recordings for the vad and speaker_encoder benchmarks (synthetic signals if unset)")
+    parser.add_argument("--spk_encoder_ckpt", type=str, default="speaker_encoder/ckpt/pretrained_bak_5805000.pt", help="speaker encoder weights for the speaker_encoder benchmark")
+    parser.add_argument("--accum_steps", type=int, default=4, help="micro-batches per step for the memory benchmark")
+    args = parser.parse_args()
+
+    hps = utils.get_hparams_from_file(args.config)
+    torch.manual_seed(1234)
+    globals()[f"bench_{args.benchmark}"](hps, args)
@@ -1,6 +1,8 @@
 import math
+import inspect
 import numpy as np
 import torch
+import torch.utils.checkpoint
 from torch import nn
 from torch.nn import functional as F
 
@@ -117,6 +119,11 @@ def fused_add_tanh_sigmoid_multiply(input_a, input_b, n_channels):
   return acts
 
 
+def tanh_sigmoid_multiply(x, n_channels: int):
+  """WaveNet gate in plain ops (fused by torch.compile; also safe to recompute under checkpointing)"""
+  return torch.tanh(x[:, :n_channels, :]) * torch.sigmoid(x[:, n_channels:, :])
+
+
 def convert_pad_shape(pad_shape):
   l = pad_shape[::-1]
   pad_shape = [item for sublist in l for item in sublist]
@@ -153,19 +160,60 @@ def generate_path(duration, mask):
   return path
 
 
+def grad_norm(parameters, norm_type=2):
+  """Total norm of the gradients as a 0-dim tensor on their device; nothing is synced to the host until it is read"""
+  if isinstance(parameters, torch.Tensor):
+    parameters = [parameters]
+  grads = [p.grad.detach() for p in parameters if p.grad is not None]
+  norm_type = float(norm_type)
+  if len(grads) == 0:
+    return torch.tensor(0.)
+  if hasattr(torch, "_foreach_norm"):
+    # one batched kernel launch per dtype/device group instead of one norm per parameter
+    norms = torch._foreach_norm(grads, norm_type)
+  else:
+    norms = [torch.norm(g, norm_type) for g in grads]
+  return torch.norm(torch.stack(norms), norm_type)
+
+
 def clip_grad_value_(parameters, clip_value, norm_type=2):
   if isinstance(parameters, torch.Tensor):
     parameters = [parameters]
   parameters = list(filter(lambda p: p.grad is not None, parameters))
-  norm_type = float(norm_type)
+  total_norm = grad_norm(parameters, norm_type)
   if clip_value is not None:
     clip_value = float(clip_value)
-
-  total_norm = 0
-  for p in parameters:
-    param_norm = p.grad.data.norm(norm_type)
-    total_norm += param_norm.item() ** norm_type
-    if clip_value is not None:
+    for p in parameters:
       p.grad.data.clamp_(min=-clip_value, max=clip_value)
-  total_norm = total_norm ** (1. / norm_type)
-  return total_norm
+  return total_norm.item()
+
+
+def freeze_parameters(model, prefixes):
+  """Sets requires_grad=False on parameters named `prefix` or `prefix.*`. Returns (n_frozen, n_total) element counts."""
+  n_frozen, n_total = 0, 0
+  for name, p in model.named_parameters():
+    n_total += p.numel()
+    if any(name == prefix or name.startswith(prefix + ".") for prefix in prefixes):
+      p.requires_grad_(False)
+      n_frozen += p.numel()
+  return n_frozen, n_total
+
+
+# non-reentrant checkpointing (torch >= 1.11) also works when no input requires grad
+_checkpoint_kwargs = {"use_reentrant": False} \
+  if "use_reentrant" in inspect.signature(torch.utils.checkpoint.checkpoint).parameters else {}
+
+
+def checkpoint(function, *args):
+  """Recomputes function(*args) in the backward pass instead of keeping its activations"""
+  return torch.utils.checkpoint.checkpoint(function, *args, **_checkpoint_kwargs)
+
+
+def set_gradient_checkpointing(model, enabled=True):
+  """Toggles activation checkpointing on every submodule that supports it. Returns the number of such submodules."""
+  n_modules = 0
+  for m in model.modules():
+    if hasattr(m, "gradient_checkpointing"):
+      m.gradient_checkpointing = enabled
+      n_modules += 1
+  return n_modules
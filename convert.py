@@ -7,8 +7,9 @@ from scipy.io.wavfile import write
 from tqdm import tqdm
 import numpy as np
 import utils
-from models import SynthesizerTrn
-from mel_processing import mel_spectrogram_torch
+from models import SynthesizerTrn, compile_generator
+from mel_processing import MelFrontend
+from resample import load_audio
 from wavlm import WavLM, WavLMConfig
 from speaker_encoder.voice_encoder import SpeakerEncoder
 import logging
@@ -27,6 +28,7 @@ if __name__ == "__main__":
     parser.add_argument("--use_timestamp", default=False, action="store_true")
     parser.add_argument("--saved_embedding", type=str, default=None, help="path to saved embedding (.npy or .pt)")
     parser.add_argument("--input_audio", type=str, default=None, help="path to input audio file for direct processing")
+    parser.add_argument("--compile", default=False, action="store_true", help="torch.compile the generator (pays off over many files)")
     args = parser.parse_args()
 
     os.makedirs(args.outdir, exist_ok=True)
@@ -39,6 +41,9 @@ if __name__ == "__main__":
         **hps.model).to(device)
     _ = net_g.eval()
     _ = utils.load_checkpoint(args.ptfile, net_g, None, True)
+    if args.compile:
+        compile_generator(net_g, dynamic=True)
+    mel_frontend = MelFrontend.from_hparams(hps.data).to(device)
 
     print("Loading WavLM for content...")
     cmodel = utils.get_cmodel(0)
@@ -69,7 +74,7 @@ if __name__ == "__main__":
         with torch.no_grad():
             # Process source audio
             print("Loading source audio...")
-            wav_src, _ = librosa.load(src, sr=hps.data.sampling_rate)
+            wav_src, _ = load_audio(src, sr=hps.data.sampling_rate)
 
             if wav_src.size == 0:
                 raise ValueError("Input audio is empty or invalid.")
@@ -134,28 +139,19 @@ if __name__ == "__main__":
                         smodel = SpeakerEncoder('speaker_encoder/ckpt/pretrained_bak_5805000.pt')
 
                         # Compute embedding from target audio (original behavior)
-                        wav_tgt, _ = librosa.load(tgt, sr=hps.data.sampling_rate)
+                        wav_tgt, _ = load_audio(tgt, sr=hps.data.sampling_rate)
                         wav_tgt, _ = librosa.effects.trim(wav_tgt, top_db=20)
                         g_tgt = smodel.embed_utterance(wav_tgt)
                         g_tgt = torch.from_numpy(g_tgt).unsqueeze(0).to(device)
                 else:
                 # Original mel spectrogram behavior
-                    wav_tgt, _ = librosa.load(tgt, sr=hps.data.sampling_rate)
+                    wav_tgt, _ = load_audio(tgt, sr=hps.data.sampling_rate)
                     wav_tgt, _ = librosa.effects.trim(wav_tgt, top_db=20)
                     wav_tgt = torch.from_numpy(wav_tgt).unsqueeze(0).to(device)
-                    mel_tgt = mel_spectrogram_torch(
-                        wav_tgt,
-                        hps.data.filter_length,
-                        hps.data.n_mel_channels,
-                        hps.data.sampling_rate,
-                        hps.data.hop_length,
-                        hps.data.win_length,
-                        hps.data.mel_fmin,
-                        hps.data.mel_fmax
-                    )
+                    mel_tgt = mel_frontend(wav_tgt)
 
                 # src
-                wav_src, _ = librosa.load(src, sr=hps.data.sampling_rate)
+                wav_src, _ = load_audio(src, sr=hps.data.sampling_rate)
                 wav_src = torch.from_numpy(wav_src).unsqueeze(0).to(device)
                 c = utils.get_content(cmodel, wav_src)
 
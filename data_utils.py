@@ -1,16 +1,86 @@
 import time
 import os
+import json
 import random
 import numpy as np
 import torch
 import torch.utils.data
+import soundfile
 
 import commons 
-from mel_processing import spectrogram_torch, spec_to_mel_torch
-from utils import load_wav_to_torch, load_filepaths_and_text, transform
+from mel_processing import MelFrontend, mel_spectrogram_torch
+from resample import resample
+from utils import load_wav_to_torch, load_filepaths_and_text, transform, get_content
 #import h5py
 
 
+def wav_num_samples(filename):
+    """Exact number of samples in a wav file, read from the header only (any libsndfile format and bit depth)."""
+    return soundfile.info(filename).frames
+
+
+def wavlm_num_frames(num_samples, conv_layers=((10, 5),) + ((3, 2),) * 4 + ((2, 2),) * 2):
+    """Number of WavLM frames produced for `num_samples` input samples."""
+    length = num_samples
+    for kernel_size, stride in conv_layers:
+        length = max(0, (length - kernel_size) // stride + 1)
+    return length
+
+
+def load_length_index(filelist, audiopaths, hop_length):
+    """
+    Returns {path: (num_samples, spec_frames, wavlm_frames)} for all audiopaths.
+    Lengths are cached in a sidecar next to the filelist, with the size and mtime of each
+    file; only paths missing from it or rewritten since are probed, so after the first run
+    startup reads a single file and stats the wavs.
+    train.py builds the index before spawning the DDP ranks, which then only read it; the
+    temporary file is per process in case several processes still write it concurrently.
+    """
+    index_path = filelist + ".lengths.json"
+    entries = {}
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+        entries = index["entries"]
+        if index["hop_length"] != hop_length:
+            entries = {k: [v[0], v[0] // hop_length] + v[2:] for k, v in entries.items()}
+
+    missing = []
+    for path in audiopaths:
+        stat = os.stat(path)
+        # entries written before size/mtime were stored are probed again
+        if entries.get(path, [])[3:] != [stat.st_size, stat.st_mtime]:
+            missing.append((path, stat))
+    for path, stat in missing:
+        num_samples = wav_num_samples(path)
+        entries[path] = [num_samples, num_samples // hop_length, wavlm_num_frames(num_samples), stat.st_size, stat.st_mtime]
+
+    if missing or not os.path.exists(index_path):
+        tmp_path = "{}.{}.tmp".format(index_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"hop_length": hop_length, "entries": entries}, f)
+        os.replace(tmp_path, index_path)
+    return {p: tuple(entries[p][:3]) for p in audiopaths}
+
+
+def build_length_index(filelist, hop_length):
+    """Builds (or refreshes) the length index of a filelist, see load_length_index"""
+    load_length_index(filelist, [x[0] for x in load_filepaths_and_text(filelist)], hop_length)
+
+
+def enc_p_cache_path(cache_dir, c_filename):
+    """Cache file holding the frozen enc_p outputs for the WavLM features in c_filename."""
+    return os.path.join(cache_dir, c_filename.replace("/", "_"))
+
+
+def _crop(x, start, length):
+    """x[:, start:start+length], zero-padded on the right if x is too short."""
+    x = x[:, start:start+length]
+    if x.size(1) < length:
+        x = torch.nn.functional.pad(x, (0, length - x.size(1)))
+    return x
+
+
 """Multi speaker version"""
 class TextAudioSpeakerLoader(torch.utils.data.Dataset):
     """
@@ -19,6 +89,7 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
         3) computes spectrograms from audio files.
     """
     def __init__(self, audiopaths, hparams):
+        self.filelist = audiopaths
         self.audiopaths = load_filepaths_and_text(audiopaths)
         self.max_wav_value = hparams.data.max_wav_value
         self.sampling_rate = hparams.data.sampling_rate
@@ -29,6 +100,11 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
         self.use_sr = hparams.train.use_sr
         self.use_spk = hparams.model.use_spk
         self.spec_len = hparams.train.max_speclen
+        self.frontend = MelFrontend.from_hparams(hparams.data)
+        # set by train.py when enc_p is frozen: items then carry [m_p; logs_p] instead of c
+        self.enc_p_cache_dir = None
+        # cleared by train.py when SRAugment recomputes c from the audio: items then carry an empty c
+        self.load_content = True
 
         random.seed(1234)
         random.shuffle(self.audiopaths)
@@ -38,14 +114,16 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
         """
         Filter text & store spec lengths
         """
-        # Store spectrogram lengths for Bucketing
-        # wav_length ~= file_size / (wav_channels * Bytes per dim) = file_size / (1 * 2)
-        # spec_length = wav_length // hop_length
+        # Store exact spectrogram lengths for Bucketing, read from the cached length index
+        # spec_length = wav_length // hop_length (MelFrontend pads (n_fft-hop)/2 per side)
+        index = load_length_index(self.filelist, [x[0] for x in self.audiopaths], self.hop_length)
+        self.wav_lengths = [index[x[0]][0] for x in self.audiopaths]
+        self.lengths = [index[x[0]][1] for x in self.audiopaths]
+        self.c_lengths = [index[x[0]][2] for x in self.audiopaths]
 
-        lengths = []
-        for audiopath in self.audiopaths:
-            lengths.append(os.path.getsize(audiopath[0]) // (2 * self.hop_length))
-        self.lengths = lengths
+    def content_filename(self, filename):
+        c_filename = filename.replace(".wav", ".pt")
+        return c_filename.replace("/wavs", "/wavlm")
 
     def get_audio(self, filename):
         audio, sampling_rate = load_wav_to_torch(filename)
@@ -58,9 +136,7 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
         if os.path.exists(spec_filename):
             spec = torch.load(spec_filename)
         else:
-            spec = spectrogram_torch(audio_norm, self.filter_length,
-                self.sampling_rate, self.hop_length, self.win_length,
-                center=False)
+            spec = self.frontend.spectrogram(audio_norm)
             spec = torch.squeeze(spec, 0)
             torch.save(spec, spec_filename)
             
@@ -69,15 +145,12 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
             spk_filename = spk_filename.replace("/wavs", "/spk")
             spk = torch.from_numpy(np.load(spk_filename))
 
-        if not self.use_sr:
-            c_filename = filename.replace(".wav", ".pt")
-            c_filename = c_filename.replace("/wavs", "/wavlm")
-            c = torch.load(c_filename).squeeze(0)
+        c_filename = self.content_filename(filename)
+        if not self.load_content:
+            c = torch.zeros(0, spec.size(-1) - 1)
+        elif self.enc_p_cache_dir is not None:
+            c = torch.load(enc_p_cache_path(self.enc_p_cache_dir, c_filename))
         else:
-            i = random.randint(68,92)
-            # c_filename = filename.replace(".wav", f"_{i}.pt")
-            c_filename = filename.replace(".wav", f".pt")
-            c_filename = c_filename.replace("/wavs", "/wavlm")
             c = torch.load(c_filename).squeeze(0)
             
         # 2023.01.10 update: code below can deteriorate model performance
@@ -112,12 +185,13 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
 
 
 class TextAudioSpeakerCollate():
-    """ Zero-pads model inputs and targets
+    """ Crops model inputs and targets to a common random window
     """
-    def __init__(self, hps):
+    def __init__(self, hps, crop=True):
         self.hps = hps
         self.use_sr = hps.train.use_sr
         self.use_spk = hps.model.use_spk
+        self.crop = crop
 
     def __call__(self, batch):
         """Collate's training batch from normalized text, audio and speaker identities
@@ -125,6 +199,37 @@ class TextAudioSpeakerCollate():
         ------
         batch: [text_normalized, spec_normalized, wav_normalized, sid]
         """
+        if self.crop:
+            return self.collate_cropped(batch)
+        return self.collate_padded(batch)
+
+    def collate_cropped(self, batch):
+        """
+        Picks the window length and per-item start offsets up front and copies only
+        the window out of each item, instead of zero-padding the full utterances
+        and slicing afterwards. This is not vectorized: the window of each item is
+        still sliced in Python (a view) and torch.stack copies them once; what it
+        saves is building and filling the full-length zero-padded buffers. Output
+        shapes and the window distribution match collate_padded.
+        """
+        hop_length = self.hps.data.hop_length
+        spec_lengths = torch.LongTensor([x[1].size(1) for x in batch])
+        spec_seglen = min(int(spec_lengths.min()), self.hps.train.max_speclen + 1)
+
+        ids_slice = (torch.rand(len(batch)) * (spec_lengths - spec_seglen)).long().tolist()
+        # the last frame of the window is dropped, as in collate_padded
+        seglen = spec_seglen - 1
+        c_padded = torch.stack([_crop(x[0], i, seglen) for x, i in zip(batch, ids_slice)])
+        spec_padded = torch.stack([x[1][:, i:i+seglen] for x, i in zip(batch, ids_slice)])
+        wav_padded = torch.stack([_crop(x[2], i * hop_length, seglen * hop_length) for x, i in zip(batch, ids_slice)])
+
+        if self.use_spk:
+            spks = torch.stack([x[3] for x in batch])
+            return c_padded, spec_padded, wav_padded, spks
+        else:
+            return c_padded, spec_padded, wav_padded
+
+    def collate_padded(self, batch):
         # Right zero-pad all one-hot text sequences to max input length
         _, ids_sorted_decreasing = torch.sort(
             torch.LongTensor([x[0].size(1) for x in batch]),
@@ -181,6 +286,55 @@ class TextAudioSpeakerCollate():
           return c_padded, spec_padded, wav_padded
 
 
+class SRAugment(torch.nn.Module):
+    """
+    Spectrogram-resize (SR) augmentation of the content input, computed per batch on the
+    training device instead of precomputed by preprocess_sr.py (25 wavs and 25 WavLM
+    files per utterance). The audio windows of a batch are resampled to the vocoder rate,
+    their mel resized to one random height in [min_height, max_height] (utils.transform),
+    vocoded, resampled back and encoded by WavLM.
+    Vocoder and WavLM are frozen and run in chunks of at most chunk_seconds of audio,
+    which bounds the memory the stage takes on top of training.
+    Nothing is cached: the random crop and height make a (utterance, height) feature cache
+    rarely hit, so every batch recomputes its features.
+    """
+    def __init__(self, vocoder, cmodel, sampling_rate, hop_length, min_height=68, max_height=92, chunk_seconds=None):
+        super().__init__()
+        self.vocoder = vocoder.eval().requires_grad_(False)
+        self.cmodel = cmodel.eval().requires_grad_(False)
+        self.sampling_rate = sampling_rate
+        self.hop_length = hop_length
+        self.min_height = min_height
+        self.max_height = max_height
+        self.chunk_seconds = chunk_seconds
+
+    def chunk_size(self, y):
+        if self.chunk_seconds is None:
+            return y.size(0)
+        return max(1, int(self.chunk_seconds * self.sampling_rate // y.size(-1)))
+
+    @torch.no_grad()
+    def forward(self, y, height=None):
+        """y: [b, 1, t] audio windows -> c: [b, ssl_dim, t // hop_length]"""
+        if height is None:
+            height = random.randint(self.min_height, self.max_height)
+        h = self.vocoder.h
+        frames = y.size(-1) // self.hop_length
+        c = []
+        for y_chunk in y.split(self.chunk_size(y)):
+            wav = resample(y_chunk.squeeze(1), self.sampling_rate, h.sampling_rate)
+            mel = mel_spectrogram_torch(wav, h.n_fft, h.num_mels, h.sampling_rate, h.hop_size, h.win_size, h.fmin, h.fmax)
+            wav = self.vocoder(transform(mel, height)).squeeze(1)
+            wav = resample(wav, h.sampling_rate, self.sampling_rate)
+            c.append(get_content(self.cmodel, wav))
+        c = torch.cat(c, 0)
+        # WavLM gives one frame less than the spectrogram of the window (and the vocoder can drop a
+        # few samples): repeat the last frame, as a full utterance would have a frame there
+        c = c[:, :, :frames]
+        c = torch.nn.functional.pad(c, (0, frames - c.size(-1)), mode="replicate")
+        return c
+
+
 class DistributedBucketSampler(torch.utils.data.distributed.DistributedSampler):
     """
     Maintain similar input lengths in a batch.
@@ -278,3 +432,86 @@ class DistributedBucketSampler(torch.utils.data.distributed.DistributedSampler):
 
     def __len__(self):
         return self.num_samples // self.batch_size
+
+
+class DistributedDynamicBucketSampler(DistributedBucketSampler):
+    """
+    Bucket sampler that forms batches under a frame budget instead of a fixed batch size.
+    Items of a (shuffled) bucket are added to a batch while its cost stays within max_frames:
+    sum(min(length, max_len)) over its items when the collate crops them to at most `max_len`
+    frames, batch size x longest item when it pads them (max_len=None). Short utterances are
+    packed into larger batches and long ones into smaller, keeping memory per step flat. Under
+    cropping every item of max_len frames or more costs the same, so buckets above max_len all
+    get max_frames // max_len items; only the shorter items make batches larger.
+
+    Batches are deterministic per epoch; the batches of all ranks are formed together and
+    dealt round-robin, so every rank sees the same number of batches. Their number depends on
+    the epoch's shuffle, so len() is the one of the current epoch (set_epoch).
+
+    The collate crops every item of a batch to one window of min(shortest item, max_len)
+    frames, so nothing is padded; what a batch loses is the audio of its longer items that
+    falls outside the window. `crop_efficiency` is, for the last epoch, the frames fed
+    (batch size x window) over the frames its items could have fed (sum of min(length, max_len)).
+    """
+    def __init__(self, dataset, max_frames, boundaries, num_replicas=None, rank=None, shuffle=True, max_len=None):
+        self.max_frames = max_frames
+        self.max_len = max_len
+        self.crop_efficiency = None
+        self._epoch_batches = None
+        super().__init__(dataset, 1, boundaries, num_replicas=num_replicas, rank=rank, shuffle=shuffle)
+
+    def _cost(self, length):
+        return length if self.max_len is None else min(length, self.max_len)
+
+    def _all_batches(self):
+        """The batches of every rank for the current epoch, before they are dealt"""
+        if self._epoch_batches is not None and self._epoch_batches[0] == self.epoch:
+            return self._epoch_batches[1]
+        # deterministically shuffle based on epoch
+        g = torch.Generator()
+        g.manual_seed(self.epoch)
+
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                ids_bucket = torch.randperm(len(bucket), generator=g).tolist()
+            else:
+                ids_bucket = list(range(len(bucket)))
+            batch, frames, longest = [], 0, 0
+            for idx in ids_bucket:
+                cost = self._cost(self.lengths[bucket[idx]])
+                if self.max_len is None:
+                    over = (len(batch) + 1) * max(longest, cost) > self.max_frames
+                else:
+                    over = frames + cost > self.max_frames
+                if batch and over:
+                    batches.append(batch)
+                    batch, frames, longest = [], 0, 0
+                batch.append(bucket[idx])
+                frames, longest = frames + cost, max(longest, cost)
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            batch_ids = torch.randperm(len(batches), generator=g).tolist()
+            batches = [batches[i] for i in batch_ids]
+        # add extra batches to make it evenly divisible
+        rem = (self.num_replicas - len(batches) % self.num_replicas) % self.num_replicas
+        batches = batches + (batches * self.num_replicas)[:rem]
+        self._epoch_batches = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        batches = self._all_batches()[self.rank::self.num_replicas]
+        fed_frames = 0
+        available_frames = 0
+        for batch in batches:
+            lengths = [self._cost(self.lengths[idx]) for idx in batch]
+            fed_frames += len(batch) * min(lengths)
+            available_frames += sum(lengths)
+        self.batches = batches
+        self.crop_efficiency = fed_frames / max(available_frames, 1)
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self._all_batches()) // self.num_replicas
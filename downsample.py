@@ -1,39 +1,58 @@
 import os
 import argparse
+import time
 import librosa
 import numpy as np
+import torch
+from functools import partial
 from multiprocessing import Pool, cpu_count
 from scipy.io import wavfile
 from tqdm import tqdm
 
+from resample import load_audio, resample
 
-def process(wav_name):
-    # speaker 's5', 'p280', 'p315' are excluded,
-    speaker = wav_name[:4]
-    wav_path = os.path.join(args.in_dir, speaker, wav_name)
-    if os.path.exists(wav_path) and '_mic2.flac' in wav_path:
-        os.makedirs(os.path.join(args.out_dir1, speaker), exist_ok=True)
-        os.makedirs(os.path.join(args.out_dir2, speaker), exist_ok=True)
-        wav, sr = librosa.load(wav_path)
-        wav, _ = librosa.effects.trim(wav, top_db=20)
-        peak = np.abs(wav).max()
-        if peak > 1.0:
-            wav = 0.98 * wav / peak
-        wav1 = librosa.resample(wav, orig_sr=sr, target_sr=args.sr1)
-        wav2 = librosa.resample(wav, orig_sr=sr, target_sr=args.sr2)
-        save_name = wav_name.replace("_mic2.flac", ".wav")
-        save_path1 = os.path.join(args.out_dir1, speaker, save_name)
-        save_path2 = os.path.join(args.out_dir2, speaker, save_name)
-        wavfile.write(
-            save_path1,
-            args.sr1,
-            (wav1 * np.iinfo(np.int16).max).astype(np.int16)
-        )
-        wavfile.write(
-            save_path2,
-            args.sr2,
-            (wav2 * np.iinfo(np.int16).max).astype(np.int16)
-        )
+
+def write(save_path, sr, wav):
+    # atomic, so that an interrupted run never leaves a truncated file that would be skipped
+    wavfile.write(save_path + ".tmp", sr, (wav * np.iinfo(np.int16).max).astype(np.int16))
+    os.replace(save_path + ".tmp", save_path)
+
+
+def process(sr1, sr2, task):
+    """Writes both output rates of one file from a single decode; returns the seconds of audio read"""
+    wav_path, save_path1, save_path2 = task
+    # decoded at the native rate (48k for VCTK) and resampled once to each output rate
+    wav, sr = load_audio(wav_path)
+    wav, _ = librosa.effects.trim(wav, top_db=20)
+    peak = np.abs(wav).max()
+    if peak > 1.0:
+        wav = 0.98 * wav / peak
+    write(save_path1, sr1, resample(wav, sr, sr1))
+    write(save_path2, sr2, resample(wav, sr, sr2))
+    return len(wav) / sr
+
+
+def list_tasks(in_dir, out_dir1, out_dir2):
+    """(input, output 1, output 2) paths of every speaker's files, without the ones already written"""
+    tasks, n_done = [], 0
+    for speaker in sorted(os.listdir(in_dir)):
+        spk_dir = os.path.join(in_dir, speaker)
+        if not os.path.isdir(spk_dir):
+            continue
+        # speaker 's5', 'p280', 'p315' are excluded (no mic2 recordings),
+        for wav_name in sorted(os.listdir(spk_dir)):
+            if '_mic2.flac' not in wav_name:
+                continue
+            save_name = wav_name.replace("_mic2.flac", ".wav")
+            save_path1 = os.path.join(out_dir1, speaker, save_name)
+            save_path2 = os.path.join(out_dir2, speaker, save_name)
+            if os.path.exists(save_path1) and os.path.exists(save_path2):
+                n_done += 1
+                continue
+            os.makedirs(os.path.dirname(save_path1), exist_ok=True)
+            os.makedirs(os.path.dirname(save_path2), exist_ok=True)
+            tasks.append((os.path.join(spk_dir, wav_name), save_path1, save_path2))
+    return tasks, n_done
 
 
 if __name__ == "__main__":
@@ -43,13 +62,22 @@ if __name__ == "__main__":
     parser.add_argument("--in_dir", type=str, default="/home/Datasets/lijingyi/data/vctk/wav48_silence_trimmed/", help="path to source dir")
     parser.add_argument("--out_dir1", type=str, default="./dataset/vctk-16k", help="path to target dir")
     parser.add_argument("--out_dir2", type=str, default="./dataset/vctk-22k", help="path to target dir")
+    parser.add_argument("--num_workers", type=int, default=None, help="worker processes (default: all cores but 2)")
     args = parser.parse_args()
 
-    pool = Pool(processes=cpu_count()-2)
-
-    for speaker in os.listdir(args.in_dir):
-        spk_dir = os.path.join(args.in_dir, speaker)
-        if os.path.isdir(spk_dir):
-            for _ in tqdm(pool.imap_unordered(process, os.listdir(spk_dir))):
-                pass
+    tasks, n_done = list_tasks(args.in_dir, args.out_dir1, args.out_dir2)
+    print(f"{len(tasks)} files to process, {n_done} already done")
 
+    # one queue over the files of all speakers, so no worker idles at a speaker boundary;
+    # one torch thread per worker, the pool already uses every core
+    num_workers = args.num_workers or max(1, cpu_count() - 2)
+    start = time.perf_counter()
+    seconds = 0.
+    with Pool(processes=num_workers, initializer=torch.set_num_threads, initargs=(1,)) as pool:
+        for duration in tqdm(pool.imap_unordered(partial(process, args.sr1, args.sr2), tasks, chunksize=8), total=len(tasks)):
+            seconds += duration
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - start
+    print(f"Processed {len(tasks)} files ({seconds / 3600:.2f} h of trimmed audio) in {elapsed:.1f} s with {num_workers} workers: "
+          f"{len(tasks) / max(elapsed, 1e-9):.1f} files/s, {seconds / max(elapsed, 1e-9):.0f}x real time")
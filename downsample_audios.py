@@ -1,6 +1,7 @@
 import librosa
 import os
 import soundfile as sf
+from resample import load_audio
 
 # Define the directory containing the audio segments
 save_dir = "dataset/messi/"
@@ -19,7 +20,7 @@ for root, folder, files in os.walk(segments_dir):
         durations.append(duration)
 
         # Downsample
-        y, sr = librosa.load(relative_path, sr=16000)  # This loads and resamples audio to 16kHz
+        y, sr = load_audio(relative_path, sr=16000)  # This loads and resamples audio to 16kHz
         # Define save path
         folder = root.split('/')[-1]
         new_path = os.path.join(save_dir, folder)
@@ -0,0 +1,137 @@
+import os
+import torch
+import librosa
+import numpy as np
+from resample import load_audio
+from speaker_encoder.params_data import sampling_rate
+
+
+def load_wav(wav_path):
+    wav, _ = load_audio(wav_path, sr=sampling_rate)
+    wav, _ = librosa.effects.trim(wav, top_db=20)
+    return wav
+
+
+class EnrollmentStore:
+    """
+    Incremental speaker enrollment. For every speaker the store keeps the running sum and count
+    of the partial-utterance embeddings of its clips, so adding clips only embeds the new audio,
+    and the per-clip embeddings, so clips that do not sound like the rest can be dropped from the
+    sums without re-embedding anything.
+    The speaker embedding is the L2-normed mean of the partial embeddings of all its clips, as
+    SpeakerEncoder.embed_utterances computes it for a single utterance.
+
+    The store is one torch file:
+    {"speakers": {speaker: {"partial_sum": [256], "n_partials": int,
+                            "clips": {path: {"mtime", "embed", "partial_sum", "n_partials", "rejected"}}}}}
+    """
+    def __init__(self, path):
+        self.path = path
+        self.speakers = {}
+        if os.path.exists(path):
+            self.speakers = torch.load(path)["speakers"]
+
+    def save(self):
+        # atomic, an interrupted save keeps the previous store
+        torch.save({"speakers": self.speakers}, self.path + ".tmp")
+        os.replace(self.path + ".tmp", self.path)
+
+    def speaker(self, name):
+        if name not in self.speakers:
+            self.speakers[name] = {"partial_sum": None, "n_partials": 0, "clips": {}}
+        return self.speakers[name]
+
+    def add(self, encoder, name, wav_paths, batch_size=32):
+        """
+        Embeds the clips of <wav_paths> not in the store yet (or modified since they were
+        embedded) and adds them to the running sums of speaker <name>.
+        :return: the paths that were embedded
+        """
+        spk = self.speaker(name)
+        new_paths = []
+        for path in wav_paths:
+            clip = spk["clips"].get(path)
+            if clip is not None and clip["mtime"] == os.path.getmtime(path):
+                continue
+            if clip is not None:
+                self.remove(name, [path])
+            new_paths.append(path)
+
+        for i in range(0, len(new_paths), batch_size):
+            paths = new_paths[i:i+batch_size]
+            embeds, partial_embeds, _ = encoder.embed_utterances([load_wav(path) for path in paths], return_partials=True)
+            for path, embed, partials in zip(paths, embeds, partial_embeds):
+                clip = {"mtime": os.path.getmtime(path), "embed": torch.from_numpy(embed),
+                        "partial_sum": torch.from_numpy(partials.sum(0)), "n_partials": len(partials),
+                        "rejected": False}
+                spk["clips"][path] = clip
+                self._accumulate(spk, clip, 1)
+        return new_paths
+
+    def remove(self, name, wav_paths):
+        spk = self.speakers[name]
+        for path in wav_paths:
+            clip = spk["clips"].pop(path)
+            if not clip["rejected"]:
+                self._accumulate(spk, clip, -1)
+
+    def prune(self, name, wav_paths):
+        """
+        Removes the clips of speaker <name> that are not in <wav_paths> from the store and the running sums.
+        :return: the paths that were removed
+        """
+        keep = set(wav_paths)
+        removed = [path for path in self.speakers[name]["clips"] if path not in keep]
+        self.remove(name, removed)
+        return removed
+
+    @staticmethod
+    def _accumulate(spk, clip, sign):
+        if spk["partial_sum"] is None:
+            spk["partial_sum"] = torch.zeros_like(clip["partial_sum"])
+        spk["partial_sum"] = spk["partial_sum"] + sign * clip["partial_sum"]
+        spk["n_partials"] += sign * clip["n_partials"]
+
+    def reject_outliers(self, name, min_similarity=0.75):
+        """
+        Takes the clips whose embedding has a cosine similarity below <min_similarity> with the
+        embedding of the speaker's other clips out of the running sums (they stay in the store,
+        marked as rejected, and are not embedded again). Rejected clips that are back above the
+        threshold are restored.
+        :return: the paths of the clips rejected after the call
+        """
+        spk = self.speakers[name]
+        # every clip against the leave-one-out centroid of the clips accepted before the call
+        rejected = {}
+        for path, clip in spk["clips"].items():
+            partial_sum, n_partials = spk["partial_sum"], spk["n_partials"]
+            if not clip["rejected"]:
+                partial_sum, n_partials = partial_sum - clip["partial_sum"], n_partials - clip["n_partials"]
+            if n_partials == 0:
+                rejected[path] = clip["rejected"]
+                continue
+            similarity = torch.dot(clip["embed"], partial_sum / torch.norm(partial_sum))
+            rejected[path] = bool(similarity < min_similarity)
+        for path, clip in spk["clips"].items():
+            if rejected[path] != clip["rejected"]:
+                self._accumulate(spk, clip, -1 if rejected[path] else 1)
+                clip["rejected"] = rejected[path]
+        return [path for path, clip in spk["clips"].items() if clip["rejected"]]
+
+    def embedding(self, name):
+        """The speaker embedding as a float32 tensor of shape (1, model_embedding_size)"""
+        spk = self.speakers[name]
+        if spk["n_partials"] == 0:
+            raise ValueError("Speaker %s has no enrolled clips" % name)
+        raw_embed = spk["partial_sum"] / spk["n_partials"]
+        return (raw_embed / torch.norm(raw_embed)).unsqueeze(0)
+
+    def export(self, name, path):
+        """Writes the speaker embedding to <path> (.npy or .pt), as convert.py --saved_embedding reads it"""
+        embed = self.embedding(name)
+        if path.endswith(".npy"):
+            np.save(path, embed.numpy())
+        elif path.endswith(".pt"):
+            torch.save(embed, path)
+        else:
+            raise ValueError("Unknown embedding format %s, expected .npy or .pt" % path)
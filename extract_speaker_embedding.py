@@ -1,30 +1,33 @@
+import argparse
 from speaker_encoder.voice_encoder import SpeakerEncoder
-import torch
-import librosa
-import numpy as np
-
-smodel = SpeakerEncoder('speaker_encoder/ckpt/pretrained_bak_5805000.pt')
-
-def get_spk_emb(wav_path, device="cpu"):
-    wav, _ = librosa.load(wav_path, sr=16000)
-    wav, _ = librosa.effects.trim(wav, top_db=20)
-    emb = smodel.embed_utterance(wav)
-    return torch.from_numpy(emb).unsqueeze(0).to(device)
-
-embeddings = []
-
-data_file = "filelists/train.txt"
-
-with open(data_file, "r") as file:
-    lines = file.readlines()
-
-# Strip newline characters from each line
-lines = [line.strip() for line in lines]
-
-for fname in lines:
-    embeddings.append(get_spk_emb(fname))
-
-# Average the embeddings
-embeddings_tensor = torch.stack(embeddings, dim=0)
-mean_embedding_tensor = torch.mean(embeddings_tensor, dim=0).unsqueeze(0)
-np.save("spk_emb.npy", mean_embedding_tensor.numpy())
\ No newline at end of file
+from enrollment import EnrollmentStore
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_file", type=str, default="filelists/train.txt", help="list of the speaker's wav paths, one per line")
+    parser.add_argument("--speaker", type=str, required=True, help="speaker name in the store")
+    parser.add_argument("--store", type=str, default="enrollment.pt", help="enrollment store; rerunning only embeds the clips it does not have")
+    parser.add_argument("--out", type=str, default="spk_emb.npy", help="exported embedding (.npy or .pt) for convert.py --saved_embedding")
+    parser.add_argument("--prune", action="store_true", help="remove the speaker's stored clips that are no longer in --data_file")
+    parser.add_argument("--min_similarity", type=float, default=None, help="leave out clips whose cosine similarity to the other clips is lower")
+    parser.add_argument("--batch_size", type=int, default=32, help="clips per encoder forward")
+    parser.add_argument("--spk_encoder_ckpt", type=str, default="speaker_encoder/ckpt/pretrained_bak_5805000.pt")
+    args = parser.parse_args()
+
+    with open(args.data_file, "r") as file:
+        lines = [line.strip() for line in file.readlines()]
+    lines = [line for line in lines if line]
+
+    store = EnrollmentStore(args.store)
+    smodel = SpeakerEncoder(args.spk_encoder_ckpt)
+    new_paths = store.add(smodel, args.speaker, lines, args.batch_size)
+    if args.prune:
+        removed = store.prune(args.speaker, lines)
+        print(f"Removed {len(removed)} clips no longer in {args.data_file}: {removed}")
+    print(f"Embedded {len(new_paths)} new clips, {len(store.speakers[args.speaker]['clips'])} in the store for {args.speaker}")
+    if args.min_similarity is not None:
+        rejected = store.reject_outliers(args.speaker, args.min_similarity)
+        print(f"Rejected {len(rejected)} clips: {rejected}")
+    store.save()
+    store.export(args.speaker, args.out)
@@ -1,46 +1,32 @@
 import torch 
+from torch import nn
 from torch.nn import functional as F
 
 import commons
+from mel_processing import MelFrontend
 
 
 def feature_loss(fmap_r, fmap_g):
-  loss = 0
-  for dr, dg in zip(fmap_r, fmap_g):
-    for rl, gl in zip(dr, dg):
-      rl = rl.float().detach()
-      gl = gl.float()
-      loss += torch.mean(torch.abs(rl - gl))
-
-  return loss * 2 
+  losses = [torch.mean(torch.abs(rl.float().detach() - gl.float()))
+            for dr, dg in zip(fmap_r, fmap_g) for rl, gl in zip(dr, dg)]
+  return torch.sum(torch.stack(losses)) * 2 
 
 
 def discriminator_loss(disc_real_outputs, disc_generated_outputs):
-  loss = 0
-  r_losses = []
-  g_losses = []
-  for dr, dg in zip(disc_real_outputs, disc_generated_outputs):
-    dr = dr.float()
-    dg = dg.float()
-    r_loss = torch.mean((1-dr)**2)
-    g_loss = torch.mean(dg**2)
-    loss += (r_loss + g_loss)
-    r_losses.append(r_loss.item())
-    g_losses.append(g_loss.item())
+  """Returns the total loss and the per-discriminator losses as detached 1-d tensors, left on the device"""
+  r_losses = torch.stack([torch.mean((1-dr.float())**2) for dr in disc_real_outputs])
+  g_losses = torch.stack([torch.mean(dg.float()**2) for dg in disc_generated_outputs])
+  loss = torch.sum(r_losses + g_losses)
 
-  return loss, r_losses, g_losses
+  return loss, r_losses.detach(), g_losses.detach()
 
 
 def generator_loss(disc_outputs):
-  loss = 0
-  gen_losses = []
-  for dg in disc_outputs:
-    dg = dg.float()
-    l = torch.mean((1-dg)**2)
-    gen_losses.append(l)
-    loss += l
+  """Returns the total loss and the per-discriminator losses as a detached 1-d tensor, left on the device"""
+  gen_losses = torch.stack([torch.mean((1-dg.float())**2) for dg in disc_outputs])
+  loss = torch.sum(gen_losses)
 
-  return loss, gen_losses
+  return loss, gen_losses.detach()
 
 
 def kl_loss(z_p, logs_q, m_p, logs_p, z_mask):
@@ -59,3 +45,49 @@ def kl_loss(z_p, logs_q, m_p, logs_p, z_mask):
   kl = torch.sum(kl * z_mask)
   l = kl / torch.sum(z_mask)
   return l
+
+
+def stft_loss(spec_r, spec_g):
+  """Spectral convergence + log STFT magnitude loss on linear magnitudes [b, f, t]."""
+  sc_loss = torch.norm(spec_r - spec_g, p="fro") / torch.norm(spec_r, p="fro")
+  mag_loss = F.l1_loss(torch.log(spec_r), torch.log(spec_g))
+  return sc_loss + mag_loss
+
+
+class SpectralLoss(nn.Module):
+  """
+  Reconstruction losses on the generated segment.
+
+  y_hat is transformed with a single STFT whose magnitudes feed both the mel L1 loss
+  (through the shared filterbank) and, when resolutions are given, the STFT loss at
+  the training resolution. Its target there is the sliced posterior spectrogram that
+  the batch already carries, so y needs an STFT only for the extra resolutions, where
+  real and generated audio go through one batched STFT.
+  """
+  def __init__(self, mel_frontend, resolutions=()):
+    super().__init__()
+    self.mel_frontend = mel_frontend
+    self.frontends = nn.ModuleList([
+        MelFrontend(n_fft, None, mel_frontend.sampling_rate, hop_size, win_size, None, None)
+        for n_fft, hop_size, win_size in resolutions])
+
+  def forward(self, y_hat, y_mel, y_spec=None, y=None):
+    """
+    y_hat, y: [b, 1, t] generated / real segments
+    y_mel, y_spec: [b, n_mels, t_t] / [b, n_fft//2+1, t_t] targets sliced from the batch
+    Returns loss_mel, loss_stft (0 without resolutions) and the generated mel.
+    """
+    spec_g = self.mel_frontend.spectrogram(y_hat.squeeze(1))
+    y_hat_mel = self.mel_frontend.spec_to_mel(spec_g)
+    loss_mel = F.l1_loss(y_mel, y_hat_mel)
+
+    loss_stft = 0
+    if len(self.frontends) > 0:
+      loss_stft = stft_loss(y_spec, spec_g)
+      y_all = torch.cat([y, y_hat], 0).squeeze(1)
+      for frontend in self.frontends:
+        spec_r, spec_g = frontend.spectrogram(y_all).chunk(2, 0)
+        loss_stft += stft_loss(spec_r, spec_g)
+      loss_stft = loss_stft / (len(self.frontends) + 1)
+
+    return loss_mel, loss_stft, y_hat_mel
@@ -44,69 +44,83 @@ def spectral_de_normalize_torch(magnitudes):
     return output
 
 
-mel_basis = {}
-hann_window = {}
+class MelFrontend(nn.Module):
+    """
+    Linear / mel spectrogram front end with the Hann window and mel filterbank held as
+    buffers, so they follow the module across .to() calls instead of being looked up in a
+    global cache on every call. Input range checks are opt-in through `validate`, since
+    they cost two full reductions (and a device sync) per call.
+    With num_mels=None only the linear spectrogram is available.
+    """
+    def __init__(self, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=False, validate=False):
+        super().__init__()
+        self.n_fft = n_fft
+        self.num_mels = num_mels
+        self.sampling_rate = sampling_rate
+        self.hop_size = hop_size
+        self.win_size = win_size
+        self.center = center
+        self.validate = validate
 
+        self.register_buffer("window", torch.hann_window(win_size), persistent=False)
+        if num_mels is not None:
+            mel = librosa_mel_fn(sr=sampling_rate, n_fft=n_fft, n_mels=num_mels, fmin=fmin, fmax=fmax)
+            self.register_buffer("mel_basis", torch.from_numpy(mel).float(), persistent=False)
 
-def spectrogram_torch(y, n_fft, sampling_rate, hop_size, win_size, center=False):
-    if torch.min(y) < -1.:
-        print('min value is ', torch.min(y))
-    if torch.max(y) > 1.:
-        print('max value is ', torch.max(y))
+    @classmethod
+    def from_hparams(cls, hps_data, **kwargs):
+        return cls(hps_data.filter_length, hps_data.n_mel_channels, hps_data.sampling_rate,
+                   hps_data.hop_length, hps_data.win_length, hps_data.mel_fmin, hps_data.mel_fmax, **kwargs)
 
-    global hann_window
-    dtype_device = str(y.dtype) + '_' + str(y.device)
-    wnsize_dtype_device = str(win_size) + '_' + dtype_device
-    if wnsize_dtype_device not in hann_window:
-        hann_window[wnsize_dtype_device] = torch.hann_window(win_size).to(dtype=y.dtype, device=y.device)
+    def spectrogram(self, y):
+        if self.validate:
+            y_min, y_max = torch.min(y), torch.max(y)
+            if y_min < -1.:
+                print('min value is ', y_min)
+            if y_max > 1.:
+                print('max value is ', y_max)
 
-    y = torch.nn.functional.pad(y.unsqueeze(1), (int((n_fft-hop_size)/2), int((n_fft-hop_size)/2)), mode='reflect')
-    y = y.squeeze(1)
+        window = self.window if self.window.dtype == y.dtype else self.window.to(y.dtype)
+        pad = int((self.n_fft-self.hop_size)/2)
+        y = torch.nn.functional.pad(y.unsqueeze(1), (pad, pad), mode='reflect')
+        y = y.squeeze(1)
 
-    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=hann_window[wnsize_dtype_device],
-                      center=center, pad_mode='reflect', normalized=False, onesided=True, return_complex=False)
+        spec = torch.stft(y, self.n_fft, hop_length=self.hop_size, win_length=self.win_size, window=window,
+                          center=self.center, pad_mode='reflect', normalized=False, onesided=True, return_complex=True)
 
-    spec = torch.sqrt(spec.pow(2).sum(-1) + 1e-6)
-    return spec
+        spec = torch.sqrt(torch.view_as_real(spec).pow(2).sum(-1) + 1e-6)
+        return spec
 
+    def spec_to_mel(self, spec):
+        mel_basis = self.mel_basis if self.mel_basis.dtype == spec.dtype else self.mel_basis.to(spec.dtype)
+        spec = torch.matmul(mel_basis, spec)
+        spec = spectral_normalize_torch(spec)
+        return spec
 
-def spec_to_mel_torch(spec, n_fft, num_mels, sampling_rate, fmin, fmax):
-    global mel_basis
-    dtype_device = str(spec.dtype) + '_' + str(spec.device)
-    fmax_dtype_device = str(fmax) + '_' + dtype_device
-    if fmax_dtype_device not in mel_basis:
-        mel = librosa_mel_fn(sr=sampling_rate, n_fft=n_fft, n_mels=num_mels, fmin=fmin, fmax=fmax)
-        mel_basis[fmax_dtype_device] = torch.from_numpy(mel).to(dtype=spec.dtype, device=spec.device)
-    spec = torch.matmul(mel_basis[fmax_dtype_device], spec)
-    spec = spectral_normalize_torch(spec)
-    return spec
+    def forward(self, y):
+        return self.spec_to_mel(self.spectrogram(y))
 
 
-def mel_spectrogram_torch(y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=False):
-    if torch.min(y) < -1.:
-        print('min value is ', torch.min(y))
-    if torch.max(y) > 1.:
-        print('max value is ', torch.max(y))
+frontends = {}
 
-    global mel_basis, hann_window
-    dtype_device = str(y.dtype) + '_' + str(y.device)
-    fmax_dtype_device = str(fmax) + '_' + dtype_device
-    wnsize_dtype_device = str(win_size) + '_' + dtype_device
-    if fmax_dtype_device not in mel_basis:
-        mel = librosa_mel_fn(sr=sampling_rate, n_fft=n_fft, n_mels=num_mels, fmin=fmin, fmax=fmax)
-        mel_basis[fmax_dtype_device] = torch.from_numpy(mel).to(dtype=y.dtype, device=y.device)
-    if wnsize_dtype_device not in hann_window:
-        hann_window[wnsize_dtype_device] = torch.hann_window(win_size).to(dtype=y.dtype, device=y.device)
 
-    y = torch.nn.functional.pad(y.unsqueeze(1), (int((n_fft-hop_size)/2), int((n_fft-hop_size)/2)), mode='reflect')
-    y = y.squeeze(1)
+def get_frontend(n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center, device):
+    key = (n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center, device)
+    if key not in frontends:
+        frontends[key] = MelFrontend(n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center).to(device)
+    return frontends[key]
 
-    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=hann_window[wnsize_dtype_device],
-                      center=center, pad_mode='reflect', normalized=False, onesided=True, return_complex=False)
 
-    spec = torch.sqrt(spec.pow(2).sum(-1) + 1e-6)
+def spectrogram_torch(y, n_fft, sampling_rate, hop_size, win_size, center=False):
+    frontend = get_frontend(n_fft, None, sampling_rate, hop_size, win_size, None, None, center, y.device)
+    return frontend.spectrogram(y)
+
 
-    spec = torch.matmul(mel_basis[fmax_dtype_device], spec)
-    spec = spectral_normalize_torch(spec)
+def spec_to_mel_torch(spec, n_fft, num_mels, sampling_rate, fmin, fmax):
+    frontend = get_frontend(n_fft, num_mels, sampling_rate, n_fft // 4, n_fft, fmin, fmax, False, spec.device)
+    return frontend.spec_to_mel(spec)
 
-    return spec
+
+def mel_spectrogram_torch(y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=False):
+    frontend = get_frontend(n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center, y.device)
+    return frontend(y)
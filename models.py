@@ -102,6 +102,12 @@ class Generator(torch.nn.Module):
 
         if gin_channels != 0:
             self.cond = nn.Conv1d(gin_channels, upsample_initial_channel, 1)
+        self.gradient_checkpointing = False
+
+    def run_resblock(self, j, x):
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            return commons.checkpoint(self.resblocks[j], x)
+        return self.resblocks[j](x)
 
     def forward(self, x, g=None):
         x = self.conv_pre(x)
@@ -111,12 +117,9 @@ class Generator(torch.nn.Module):
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, modules.LRELU_SLOPE)
             x = self.ups[i](x)
-            xs = None
-            for j in range(self.num_kernels):
-                if xs is None:
-                    xs = self.resblocks[i*self.num_kernels+j](x)
-                else:
-                    xs += self.resblocks[i*self.num_kernels+j](x)
+            xs = self.run_resblock(i*self.num_kernels, x)
+            for j in range(1, self.num_kernels):
+                xs = xs + self.run_resblock(i*self.num_kernels+j, x)
             x = xs / self.num_kernels
         x = F.leaky_relu(x)
         x = self.conv_post(x)
@@ -198,13 +201,16 @@ class DiscriminatorS(torch.nn.Module):
 
 
 class MultiPeriodDiscriminator(torch.nn.Module):
-    def __init__(self, use_spectral_norm=False):
+    def __init__(self, use_spectral_norm=False, fused_forward=False):
         super(MultiPeriodDiscriminator, self).__init__()
         periods = [2,3,5,7,11]
 
         discs = [DiscriminatorS(use_spectral_norm=use_spectral_norm)]
         discs = discs + [DiscriminatorP(i, use_spectral_norm=use_spectral_norm) for i in periods]
         self.discriminators = nn.ModuleList(discs)
+        # run each discriminator once on cat([y, y_hat]) instead of twice; the outputs are the same
+        # (with spectral norm the power iteration then runs once per call instead of twice)
+        self.fused_forward = fused_forward
 
     def forward(self, y, y_hat):
         y_d_rs = []
@@ -212,8 +218,14 @@ class MultiPeriodDiscriminator(torch.nn.Module):
         fmap_rs = []
         fmap_gs = []
         for i, d in enumerate(self.discriminators):
-            y_d_r, fmap_r = d(y)
-            y_d_g, fmap_g = d(y_hat)
+            if self.fused_forward and y.shape == y_hat.shape:
+                y_d, fmap = d(torch.cat([y, y_hat], 0))
+                y_d_r, y_d_g = y_d[:y.size(0)], y_d[y.size(0):]
+                fmap_r = [f[:y.size(0)] for f in fmap]
+                fmap_g = [f[y.size(0):] for f in fmap]
+            else:
+                y_d_r, fmap_r = d(y)
+                y_d_g, fmap_g = d(y_hat)
             y_d_rs.append(y_d_r)
             y_d_gs.append(y_d_g)
             fmap_rs.append(fmap_r)
@@ -318,8 +330,9 @@ class SynthesizerTrn(nn.Module):
     if not self.use_spk:
       self.enc_spk = SpeakerEncoder(model_hidden_size=gin_channels, model_embedding_size=gin_channels)
 
-  def forward(self, c, spec, g=None, mel=None, c_lengths=None, spec_lengths=None):
-    if c_lengths == None:
+  def forward(self, c, spec, g=None, mel=None, c_lengths=None, spec_lengths=None, p_stats=None):
+    """p_stats: precomputed [m_p; logs_p] of a frozen enc_p, used instead of running enc_p on c"""
+    if p_stats is None and c_lengths == None:
       c_lengths = (torch.ones(c.size(0)) * c.size(-1)).to(c.device)
     if spec_lengths == None:
       spec_lengths = (torch.ones(spec.size(0)) * spec.size(-1)).to(spec.device)
@@ -328,7 +341,10 @@ class SynthesizerTrn(nn.Module):
       g = self.enc_spk(mel.transpose(1,2))
     g = g.unsqueeze(-1)
       
-    _, m_p, logs_p, _ = self.enc_p(c, c_lengths)
+    if p_stats is None:
+      _, m_p, logs_p, _ = self.enc_p(c, c_lengths)
+    else:
+      m_p, logs_p = torch.split(p_stats, self.inter_channels, dim=1)
     z, m_q, logs_q, spec_mask = self.enc_q(spec, spec_lengths, g=g) 
     z_p = self.flow(z, spec_mask, g=g)
 
@@ -349,3 +365,16 @@ class SynthesizerTrn(nn.Module):
     o = self.dec(z * c_mask, g=g)
     
     return o
+
+
+def compile_generator(net_g, **kwargs):
+  """
+  torch.compile (torch >= 2.0) the forward of enc_p, enc_q, flow and dec in place, for training and infer().
+  The glue in SynthesizerTrn.forward/infer (random slicing, lengths) stays eager; state_dict keys are unchanged.
+  """
+  if not hasattr(torch, "compile"):
+    raise RuntimeError("torch.compile needs torch >= 2.0, found {}".format(torch.__version__))
+  for name in ["enc_p", "enc_q", "flow", "dec"]:
+    module = getattr(net_g, name)
+    module.forward = torch.compile(module.forward, **kwargs)
+  return net_g
@@ -117,6 +117,7 @@ class WN(torch.nn.Module):
     self.n_layers = n_layers
     self.gin_channels = gin_channels
     self.p_dropout = p_dropout
+    self.gradient_checkpointing = False
 
     self.in_layers = torch.nn.ModuleList()
     self.res_skip_layers = torch.nn.ModuleList()
@@ -145,35 +146,38 @@ class WN(torch.nn.Module):
       self.res_skip_layers.append(res_skip_layer)
 
   def forward(self, x, x_mask, g=None, **kwargs):
-    output = torch.zeros_like(x)
-    n_channels_tensor = torch.IntTensor([self.hidden_channels])
-
     if g is not None:
       g = self.cond_layer(g)
 
     for i in range(self.n_layers):
-      x_in = self.in_layers[i](x)
       if g is not None:
         cond_offset = i * 2 * self.hidden_channels
         g_l = g[:,cond_offset:cond_offset+2*self.hidden_channels,:]
       else:
-        g_l = torch.zeros_like(x_in)
-
-      acts = commons.fused_add_tanh_sigmoid_multiply(
-          x_in,
-          g_l,
-          n_channels_tensor)
-      acts = self.drop(acts)
+        g_l = None
 
-      res_skip_acts = self.res_skip_layers[i](acts)
+      if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+        res_skip_acts = commons.checkpoint(self._layer, i, x, g_l)
+      else:
+        res_skip_acts = self._layer(i, x, g_l)
       if i < self.n_layers - 1:
         res_acts = res_skip_acts[:,:self.hidden_channels,:]
         x = (x + res_acts) * x_mask
-        output = output + res_skip_acts[:,self.hidden_channels:,:]
+        skip_acts = res_skip_acts[:,self.hidden_channels:,:]
       else:
-        output = output + res_skip_acts
+        skip_acts = res_skip_acts
+      output = skip_acts if i == 0 else output + skip_acts
     return output * x_mask
 
+  def _layer(self, i, x, g_l):
+    x_in = self.in_layers[i](x)
+    if g_l is not None:
+      x_in = x_in + g_l
+
+    acts = commons.tanh_sigmoid_multiply(x_in, self.hidden_channels)
+    acts = self.drop(acts)
+    return self.res_skip_layers[i](acts)
+
   def remove_weight_norm(self):
     if self.gin_channels != 0:
       torch.nn.utils.remove_weight_norm(self.cond_layer)
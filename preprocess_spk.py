@@ -1,48 +1,74 @@
 import os, sys
 from speaker_encoder.voice_encoder import SpeakerEncoder
 from speaker_encoder.audio import preprocess_wav
+from speaker_encoder.params_data import sampling_rate
+from resample import load_audio
 from pathlib import Path
 import numpy as np
+import torch
 from os.path import join, basename, split
 from tqdm import tqdm
 from multiprocessing import cpu_count
-from concurrent.futures import ProcessPoolExecutor 
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from functools import partial
 import glob 
 import argparse
 
 
-def build_from_path(in_dir, out_dir, weights_fpath, num_workers=1):
-    executor = ProcessPoolExecutor(max_workers=num_workers)
-    futures = []
+# loaded once per worker process by init_worker
+encoder = None
+
+
+def init_worker(weights_fpath, device):
+    global encoder
+    if device == "cpu":
+        # the pool already spreads the files over the cores
+        torch.set_num_threads(1)
+    encoder = SpeakerEncoder(weights_fpath, device=device, verbose=False)
+
+
+def build_from_path(in_dir, out_dir, executor, batch_size=16, vad="webrtc"):
+    """Submits the batches of <in_dir> to <executor> and returns their futures without waiting on them"""
     wavfile_paths = glob.glob(os.path.join(in_dir, '*.wav'))
     wavfile_paths= sorted(wavfile_paths)
-    for wav_path in wavfile_paths:
+    # outputs of an earlier (interrupted) run are kept
+    wavfile_paths = [p for p in wavfile_paths if not os.path.exists(embed_path(out_dir, p))]
+    futures = []
+    for i in range(0, len(wavfile_paths), batch_size):
         futures.append(executor.submit(
-            partial(_compute_spkEmbed, out_dir, wav_path, weights_fpath)))
-    return [future.result() for future in tqdm(futures)]
+            partial(_compute_spkEmbed, out_dir, wavfile_paths[i:i+batch_size], vad)))
+    return futures
+
+def embed_path(out_dir, wav_path):
+    utt_id = os.path.splitext(os.path.basename(wav_path))[0]
+    return os.path.join(out_dir, f"{utt_id}.npy")
 
-def _compute_spkEmbed(out_dir, wav_path, weights_fpath):
-    utt_id = os.path.basename(wav_path).rstrip(".wav")
-    fpath = Path(wav_path)
-    wav = preprocess_wav(fpath)
+def _compute_spkEmbed(out_dir, wav_paths, vad="webrtc"):
+    """Embeds a batch of utterances with one LSTM forward over all their partial utterances"""
+    wavs = [preprocess_wav(load_audio(wav_path, sr=sampling_rate)[0], vad=vad) for wav_path in wav_paths]
+    embeds = encoder.embed_utterances(wavs)
 
-    encoder = SpeakerEncoder(weights_fpath, verbose=False)
-    embed = encoder.embed_utterance(wav)
-    fname_save = os.path.join(out_dir, f"{utt_id}.npy")
-    np.save(fname_save, embed, allow_pickle=False)
-    return os.path.basename(fname_save)
+    names = []
+    for wav_path, embed in zip(wav_paths, embeds):
+        fname_save = embed_path(out_dir, wav_path)
+        np.save(fname_save, embed, allow_pickle=False)
+        names.append(os.path.basename(fname_save))
+    return names
 
-def preprocess(in_dir, out_dir_root, spk, weights_fpath, num_workers):
+def preprocess(in_dir, out_dir_root, spk, executor, batch_size, vad):
     out_dir = os.path.join(out_dir_root, spk)
     os.makedirs(out_dir, exist_ok=True)
-    metadata = build_from_path(in_dir, out_dir, weights_fpath, num_workers)
+    return build_from_path(in_dir, out_dir, executor, batch_size, vad)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--in_dir', type=str, 
         default='dataset/sr/messi/wavs')
     parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=16, help="utterances per encoder forward")
+    parser.add_argument('--device', type=str, default=None, help="cuda if available, otherwise cpu")
+    parser.add_argument('--vad', type=str, default='webrtc', choices=['webrtc', 'energy'],
+        help="silence trimming VAD, energy is faster on clean recordings (see bench.py vad)")
     parser.add_argument('--out_dir_root', type=str, 
         default='dataset/sr/messi')
     parser.add_argument('--spk_encoder_ckpt', type=str,
@@ -55,17 +81,25 @@ if __name__ == "__main__":
     
     args.num_workers = args.num_workers if args.num_workers is not None else cpu_count()
     print("Number of workers: ", args.num_workers)
+    device = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
     ckpt_step = os.path.basename(args.spk_encoder_ckpt).split('.')[0].split('_')[-1]
     spk_embed_out_dir = os.path.join(args.out_dir_root, "spk")
     print("[INFO] spk_embed_out_dir: ", spk_embed_out_dir)
     os.makedirs(spk_embed_out_dir, exist_ok=True)
 
-    for spk in sub_folder_list:
-        in_dir = os.path.join(args.in_dir, spk)
-        if not os.path.isdir(in_dir):
-            continue
-        print("Preprocessing {} ...".format(in_dir))
-        preprocess(in_dir, spk_embed_out_dir, spk, args.spk_encoder_ckpt, args.num_workers)
+    # one pool for all speakers, each worker loads the encoder once; the batches of every speaker
+    # are queued before any result is awaited, so no worker idles at a speaker boundary
+    with ProcessPoolExecutor(max_workers=args.num_workers, initializer=init_worker,
+                             initargs=(args.spk_encoder_ckpt, device)) as executor:
+        futures = []
+        for spk in sub_folder_list:
+            in_dir = os.path.join(args.in_dir, spk)
+            if not os.path.isdir(in_dir):
+                continue
+            futures += preprocess(in_dir, spk_embed_out_dir, spk, executor, args.batch_size, args.vad)
+        print("Embedding {} batches ...".format(len(futures)))
+        n_files = sum(len(future.result()) for future in tqdm(as_completed(futures), total=len(futures)))
+    print("{} embeddings written".format(n_files))
     '''
     for data_split in split_list:
         in_dir = os.path.join(args.in_dir, data_split)
@@ -1,13 +1,13 @@
 import os
 import argparse
 import torch
-import librosa
 import json
 from glob import glob
 from tqdm import tqdm
 from scipy.io import wavfile
 
 import utils
+from resample import load_audio, resample
 from mel_processing import mel_spectrogram_torch
 from wavlm import WavLM, WavLMConfig
 #import h5py
@@ -23,7 +23,7 @@ def process(filename):
     ssl_dir = os.path.join(args.ssl_dir, folder)
     os.makedirs(wav_dir, exist_ok=True)
     os.makedirs(ssl_dir, exist_ok=True)
-    wav, _ = librosa.load(filename, sr=hps.sampling_rate)
+    wav, _ = load_audio(filename, sr=hps.sampling_rate)
     wav = torch.from_numpy(wav).unsqueeze(0).to(device)
     mel = mel_spectrogram_torch(
         wav, 
@@ -41,22 +41,23 @@ def process(filename):
         fpath = os.path.join(ssl_dir, f"{i}.hdf5")
         f[i] = h5py.File(fpath, "a")
     '''
-    for i in range(args.min, args.max+1):
-        mel_rs = utils.transform(mel, i)
-        with torch.no_grad():
-            wav_rs = vocoder(mel_rs)[0][0].detach().cpu().numpy()
-
-        _wav_rs = librosa.resample(wav_rs, orig_sr=hps.sampling_rate, target_sr=args.sr)
-        wav_rs = torch.from_numpy(_wav_rs).to(device).unsqueeze(0)
-        c = utils.get_content(cmodel, wav_rs)
+    # every resized copy is as long as the original, so each stage runs once on all the heights
+    heights = list(range(args.min, args.max+1))
+    mel_rs = torch.cat([utils.transform(mel, i) for i in heights], 0)
+    with torch.no_grad():
+        wav_rs = torch.cat([vocoder(m) for m in mel_rs.split(args.batch_size)], 0)
+    wav_rs = resample(wav_rs, hps.sampling_rate, args.sr)
+    _wav_rs = wav_rs.squeeze(1).cpu().numpy()
+    c = torch.cat([utils.get_content(cmodel, w) for w in wav_rs.split(args.batch_size)], 0).cpu()
+    for k, i in enumerate(heights):
         ssl_path = os.path.join(ssl_dir, basename.replace(".wav", f"_{i}.pt"))
-        torch.save(c.cpu(), ssl_path)
+        torch.save(c[k:k+1].clone(), ssl_path)
         #print(wav_rs.size(), c.size())
         wav_path = os.path.join(wav_dir, basename.replace(".wav", f"_{i}.wav"))
         wavfile.write(
                 wav_path,
                 args.sr,
-                _wav_rs
+                _wav_rs[k]
         )
     '''
         f[i][basename[:-4]] = c.cpu()
@@ -70,11 +71,15 @@ if __name__ == "__main__":
     parser.add_argument("--sr", type=int, default=16000, help="sampling rate")
     parser.add_argument("--min", type=int, default=68, help="min")
     parser.add_argument("--max", type=int, default=92, help="max")
+    parser.add_argument("--batch_size", type=int, default=None, help="resized copies per vocoder/WavLM batch (default: all on GPU, 1 on CPU)")
     parser.add_argument("--config", type=str, default="hifigan/config.json", help="path to config file")
     parser.add_argument("--in_dir", type=str, default="dataset/messi/wavs", help="path to input dir")
     parser.add_argument("--wav_dir", type=str, default="dataset/sr/messi/wavs", help="path to output wav dir")
     parser.add_argument("--ssl_dir", type=str, default="dataset/sr/messi/wavlm", help="path to output ssl dir")
     args = parser.parse_args()
+    if args.batch_size is None:
+        # on CPU the large vocoder batches run slower than single copies
+        args.batch_size = args.max - args.min + 1 if device.type == "cuda" else 1
 
     print("Loading WavLM for content...")
     checkpoint = torch.load('wavlm/WavLM-Large.pt')
@@ -1,25 +1,141 @@
 import os
+import io
+import json
 import argparse
+import hashlib
 import torch
-import librosa
+import soundfile
+import torch.multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from tqdm import tqdm
 
 import utils
+from resample import load_audio
+from data_utils import wavlm_num_frames
 from wavlm import WavLM, WavLMConfig
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def process(filename):
-    basename = os.path.basename(filename)
+
+def load_cmodel(device):
+    checkpoint = torch.load('wavlm/WavLM-Large.pt')
+    cfg = WavLMConfig(checkpoint['cfg'])
+    cmodel = WavLM(cfg).to(device)
+    cmodel.load_state_dict(checkpoint['model'])
+    cmodel.eval()
+    return cmodel
+
+
+def output_name(filename):
+    """<speaker>/<utterance>.pt, relative to out_dir"""
     filename = filename.replace('\\', '/')
     folder = filename.split('/')[-2]
-    save_dir = os.path.join(args.out_dir, folder)
-    os.makedirs(save_dir, exist_ok=True)
-    wav, _ = librosa.load(filename, sr=args.sr)
-    wav = torch.from_numpy(wav).unsqueeze(0).to(device)
-    c = utils.get_content(cmodel, wav)
-    save_name = os.path.join(save_dir, basename.replace(".wav", ".pt"))
-    torch.save(c.cpu(), save_name)
+    return os.path.join(folder, os.path.basename(filename).replace(".wav", ".pt"))
+
+
+def read_manifest(out_dir):
+    """Entries of manifest.jsonl plus those of shard manifests left behind by an interrupted run"""
+    entries = {}
+    for path in sorted(glob(os.path.join(out_dir, "manifest*.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries[entry["path"]] = entry
+    return entries
+
+
+def write_manifest(out_dir, entries):
+    tmp_path = os.path.join(out_dir, "manifest.jsonl.tmp")
+    with open(tmp_path, "w") as f:
+        for name in sorted(entries):
+            f.write(json.dumps(entries[name]) + "\n")
+    os.replace(tmp_path, os.path.join(out_dir, "manifest.jsonl"))
+    for path in glob(os.path.join(out_dir, "manifest.*.jsonl")):
+        os.remove(path)
+
+
+def is_done(entry, save_name):
+    """Valid output: listed in the manifest and of the recorded size (writes are atomic, so never truncated)"""
+    return entry is not None and os.path.exists(save_name) and os.path.getsize(save_name) == entry["bytes"]
+
+
+def make_batches(filenames, max_batch_seconds):
+    """Groups utterances of similar length, so that batch_size * longest duration stays under max_batch_seconds"""
+    durations = {f: soundfile.info(f).duration for f in filenames}
+    batches, batch = [], []
+    for filename in sorted(filenames, key=lambda f: durations[f]):
+        if batch and (len(batch) + 1) * durations[filename] > max_batch_seconds:
+            batches.append(batch)
+            batch = []
+        batch.append(filename)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def decode(filename, sr):
+    wav, _ = load_audio(filename, sr=sr)
+    return torch.from_numpy(wav)
+
+
+def save(c, save_name):
+    """Atomic torch.save; returns the sha1 and size of the written file"""
+    buffer = io.BytesIO()
+    torch.save(c, buffer)
+    data = buffer.getvalue()
+    os.makedirs(os.path.dirname(save_name), exist_ok=True)
+    with open(save_name + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(save_name + ".tmp", save_name)
+    return hashlib.sha1(data).hexdigest(), len(data)
+
+
+def process_shard(rank, args, shards):
+    batches = shards[rank]
+    if torch.cuda.is_available():
+        device = torch.device("cuda", rank % torch.cuda.device_count())
+    else:
+        device = torch.device("cpu")
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.num_procs))
+    cmodel = load_cmodel(device)
+    manifest = open(os.path.join(args.out_dir, f"manifest.{rank}.jsonl"), "a")
+
+    with ThreadPoolExecutor(args.num_workers) as pool:
+        # audio of the next batch is decoded, and outputs of the previous one written, while WavLM runs
+        decoding = [pool.submit(decode, f, args.sr) for f in batches[0]] if batches else []
+        saving = []
+        for i, batch in enumerate(tqdm(batches, position=rank, desc=f"shard {rank}")):
+            wavs = [future.result() for future in decoding]
+            if i + 1 < len(batches):
+                decoding = [pool.submit(decode, f, args.sr) for f in batches[i + 1]]
+
+            lengths = torch.LongTensor([wav.size(0) for wav in wavs])
+            wav = torch.zeros(len(wavs), int(lengths.max()))
+            for j, w in enumerate(wavs):
+                wav[j, :w.size(0)] = w
+            # WavLM splits the sample mask into one equal chunk per output frame and masks the frames whose
+            # chunk touches the padding. Masking from the first frame past each wav's own length on also hides
+            # the frames the convolutions computed from audio and zeros, so the outputs match unbatched ones
+            frames = torch.LongTensor([wavlm_num_frames(int(length)) for length in lengths])
+            chunk = wav.size(1) // wavlm_num_frames(wav.size(1))
+            padding_mask = torch.arange(wav.size(1)).unsqueeze(0) >= frames.unsqueeze(1) * chunk
+            c = utils.get_content(cmodel, wav.to(device), padding_mask.to(device)).cpu()
+
+            for entry, future in saving:
+                entry["sha1"], entry["bytes"] = future.result()
+                manifest.write(json.dumps(entry) + "\n")
+            manifest.flush()
+            saving = []
+            for j, filename in enumerate(batch):
+                n = int(frames[j])
+                name = output_name(filename)
+                entry = {"path": name, "source": filename, "samples": int(lengths[j]), "frames": n}
+                saving.append((entry, pool.submit(save, c[j:j+1, :, :n].clone(), os.path.join(args.out_dir, name))))
+
+        for entry, future in saving:
+            entry["sha1"], entry["bytes"] = future.result()
+            manifest.write(json.dumps(entry) + "\n")
+    manifest.close()
 
 
 if __name__ == "__main__":
@@ -27,20 +143,29 @@ if __name__ == "__main__":
     parser.add_argument("--sr", type=int, default=16000, help="sampling rate")
     parser.add_argument("--in_dir", type=str, default="dataset/messi", help="path to input dir")
     parser.add_argument("--out_dir", type=str, default="dataset/messi/wavlm", help="path to output dir")
+    parser.add_argument("--max_batch_seconds", type=float, default=120., help="padded audio per WavLM batch")
+    parser.add_argument("--num_workers", type=int, default=4, help="threads decoding and writing files")
+    parser.add_argument("--num_procs", type=int, default=1, help="processes, each with its own WavLM (one per GPU)")
     args = parser.parse_args()
     
     os.makedirs(args.out_dir, exist_ok=True)
 
-    print("Loading WavLM for content...")
-    checkpoint = torch.load('wavlm/WavLM-Large.pt')
-    cfg = WavLMConfig(checkpoint['cfg'])
-    cmodel = WavLM(cfg).to(device)
-    cmodel.load_state_dict(checkpoint['model'])
-    cmodel.eval()
-    print("Loaded WavLM.")
-    
     filenames = glob(f'{args.in_dir}/*/*.wav', recursive=True)
+    entries = read_manifest(args.out_dir)
+    todo = [f for f in filenames
+            if not is_done(entries.get(output_name(f)), os.path.join(args.out_dir, output_name(f)))]
+    print(f"{len(filenames) - len(todo)} of {len(filenames)} files already done")
+
+    batches = make_batches(todo, args.max_batch_seconds)
+    # batches are sorted by length, so striding over them balances the shards
+    shards = [batches[rank::args.num_procs] for rank in range(args.num_procs)]
+    if batches:
+        print("Loading WavLM for content...")
+        if args.num_procs > 1:
+            mp.spawn(process_shard, nprocs=args.num_procs, args=(args, shards))
+        else:
+            process_shard(0, args, shards)
     
-    for filename in tqdm(filenames):
-        process(filename)
-    
\ No newline at end of file
+    entries.update(read_manifest(args.out_dir))
+    write_manifest(args.out_dir, entries)
+    print(f"Wrote {os.path.join(args.out_dir, 'manifest.jsonl')} ({len(entries)} files)")
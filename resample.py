@@ -0,0 +1,95 @@
+import math
+import numpy as np
+import torch
+from torch import nn
+import torch.nn.functional as F
+import soundfile
+import librosa
+
+
+class Resampler(nn.Module):
+    """
+    Band-limited resampling with a Kaiser-windowed sinc, applied as one polyphase conv1d
+    (one output channel per phase, stride = input period) over a batch of waveforms.
+    The defaults are the parameters of resampy's "kaiser_best", the librosa 0.8 default.
+    """
+    def __init__(self, orig_sr, target_sr, lowpass_filter_width=64, rolloff=0.9475937167399596,
+                 beta=14.769656459379492):
+        super().__init__()
+        gcd = math.gcd(int(orig_sr), int(target_sr))
+        self.orig_sr = int(orig_sr)
+        self.target_sr = int(target_sr)
+        self.orig = self.orig_sr // gcd
+        self.new = self.target_sr // gcd
+
+        # cutoff in units of the reduced rates; below the lower Nyquist frequency to leave room for the transition band
+        base_freq = min(self.orig, self.new) * rolloff
+        self.width = math.ceil(lowpass_filter_width * self.orig / base_freq)
+        idx = torch.arange(-self.width, self.width + self.orig, dtype=torch.float64) / self.orig
+        t = torch.arange(0, -self.new, -1, dtype=torch.float64).unsqueeze(1) / self.new + idx
+        t = (t * base_freq).clamp(-lowpass_filter_width, lowpass_filter_width)
+        window = torch.i0(beta * torch.sqrt(1 - (t / lowpass_filter_width) ** 2)) / torch.i0(torch.tensor(beta, dtype=torch.float64))
+        t = t * math.pi
+        sinc = torch.where(t == 0, torch.ones_like(t), torch.sin(t) / t)
+        kernel = sinc * window * base_freq / self.orig
+        self.register_buffer("kernel", kernel.unsqueeze(1).float(), persistent=False)
+
+    def forward(self, wav):
+        """wav: [..., t] -> [..., ceil(t * target_sr / orig_sr)]"""
+        if self.orig_sr == self.target_sr:
+            return wav
+        shape = wav.shape
+        length = shape[-1]
+        wav = wav.reshape(-1, 1, length)
+        kernel = self.kernel if self.kernel.dtype == wav.dtype else self.kernel.to(wav.dtype)
+        wav = F.pad(wav, (self.width, self.width + self.orig))
+        # [b, new, n] -> [b, n * new]: output sample n * new + phase
+        wav = F.conv1d(wav, kernel, stride=self.orig)
+        wav = wav.transpose(1, 2).reshape(wav.size(0), -1)
+        target_length = math.ceil(self.new * length / self.orig)
+        return wav[:, :target_length].reshape(shape[:-1] + (target_length,))
+
+
+resamplers = {}
+
+
+def get_resampler(orig_sr, target_sr, device):
+    key = (int(orig_sr), int(target_sr), device)
+    if key not in resamplers:
+        resamplers[key] = Resampler(orig_sr, target_sr).to(device)
+    return resamplers[key]
+
+
+def resample(wav, orig_sr, target_sr):
+    """
+    Resamples the last axis of a torch tensor or numpy array (one waveform or a batch of
+    equal-length ones). Numpy input goes through librosa's soxr_hq and is returned as numpy:
+    on CPU, one thread per worker as the preprocessing pools run it, soxr is several times
+    faster than the conv1d (48k -> 16k, 5 s: 2.1 vs 14.8 ms). Tensors, batched or on the GPU,
+    use Resampler, which matches soxr_hq within 1e-3 (python bench.py resample).
+    """
+    if isinstance(wav, np.ndarray):
+        if orig_sr == target_sr:
+            return wav
+        return librosa.resample(wav, orig_sr=orig_sr, target_sr=target_sr, res_type="soxr_hq", axis=-1)
+    if orig_sr == target_sr:
+        return wav
+    with torch.no_grad():
+        return get_resampler(orig_sr, target_sr, wav.device)(wav)
+
+
+def load_audio(path, sr=None):
+    """
+    librosa.load(path, sr=sr) for an explicit sr: a mono float32 numpy waveform and its sampling rate,
+    resampled with `resample` instead of librosa. Unlike librosa.load, whose default is sr=22050,
+    sr=None (the default) keeps the native rate; pass sr=22050 to get librosa's default.
+    """
+    try:
+        wav, orig_sr = soundfile.read(path, dtype="float32", always_2d=True)
+        wav = wav.mean(1)
+    except RuntimeError:
+        # formats libsndfile can not decode (e.g. mp3 on older versions)
+        wav, orig_sr = librosa.load(path, sr=None)
+    if sr is None:
+        return wav, orig_sr
+    return resample(np.ascontiguousarray(wav), orig_sr, sr), sr
@@ -2,16 +2,17 @@ from scipy.ndimage.morphology import binary_dilation
 from speaker_encoder.params_data import *
 from pathlib import Path
 from typing import Optional, Union
+from functools import lru_cache
 import numpy as np
 import webrtcvad
 import librosa
-import struct
 
 int16_max = (2 ** 15) - 1
 
 
 def preprocess_wav(fpath_or_wav: Union[str, Path, np.ndarray],
-                   source_sr: Optional[int] = None):
+                   source_sr: Optional[int] = None,
+                   vad: str = "webrtc"):
     """
     Applies the preprocessing operations used in training the Speaker Encoder to a waveform 
     either on disk or in memory. The waveform will be resampled to match the data hyperparameters.
@@ -22,6 +23,7 @@ def preprocess_wav(fpath_or_wav: Union[str, Path, np.ndarray],
     preprocessing. After preprocessing, the waveform's sampling rate will match the data 
     hyperparameters. If passing a filepath, the sampling rate will be automatically detected and 
     this argument will be ignored.
+    :param vad: voice activity detector of trim_long_silences, "webrtc" or "energy"
     """
     # Load the wav from disk if needed
     if isinstance(fpath_or_wav, str) or isinstance(fpath_or_wav, Path):
@@ -35,7 +37,7 @@ def preprocess_wav(fpath_or_wav: Union[str, Path, np.ndarray],
         
     # Apply the preprocessing: normalize volume and shorten long silences 
     wav = normalize_volume(wav, audio_norm_target_dBFS, increase_only=True)
-    wav = trim_long_silences(wav)
+    wav = trim_long_silences(wav, vad)
     
     return wav
 
@@ -50,17 +52,54 @@ def wav_to_mel_spectrogram(wav):
         sr=sampling_rate,
         n_fft=int(sampling_rate * mel_window_length / 1000),
         hop_length=int(sampling_rate * mel_window_step / 1000),
-        n_mels=mel_n_channels
+        n_mels=mel_n_channels,
+        pad_mode="reflect"  # the librosa 0.8 default the encoder was trained with (later versions pad with zeros)
     )
     return frames.astype(np.float32).T
 
 
-def trim_long_silences(wav):
+@lru_cache(maxsize=None)
+def mel_filterbank(n_fft):
+    """
+    The mel filterbank of wav_to_mel_spectrogram, as a float32 array of shape 
+    (mel_n_channels, n_fft // 2 + 1); computed once per n_fft.
+    """
+    return librosa.filters.mel(sr=sampling_rate, n_fft=n_fft, n_mels=mel_n_channels).astype(np.float32)
+
+
+def webrtc_voice_flags(wav, samples_per_window):
+    """
+    Per-window voice flags of webrtcvad, on a waveform whose length is a multiple of the window size.
+    """
+    # Convert the float waveform to 16-bit mono PCM; the windows are views of the one buffer
+    pcm_wave = memoryview(np.round(wav * int16_max).astype(np.int16).tobytes())
+    
+    # Perform voice activation detection
+    vad = webrtcvad.Vad(mode=3)
+    return np.array([vad.is_speech(pcm_wave[window_start * 2:(window_start + samples_per_window) * 2],
+                                   sample_rate=sampling_rate)
+                     for window_start in range(0, len(wav), samples_per_window)], dtype=bool)
+
+
+def energy_voice_flags(wav, samples_per_window, threshold_db=vad_energy_threshold):
+    """
+    Vectorized alternative to webrtc_voice_flags: a window is voiced when its energy is within 
+    <threshold_db> of the loudest window of the waveform. Meant for clean recordings, where it 
+    is much faster and agrees with webrtcvad on most windows (see bench.py vad); it does not 
+    tell speech from other loud sounds.
+    """
+    windows = wav.reshape(-1, samples_per_window).astype(np.float64)
+    energy_db = 10 * np.log10(np.mean(windows ** 2, axis=1) + 1e-10)
+    return energy_db > energy_db.max() + threshold_db
+
+
+def trim_long_silences(wav, vad="webrtc"):
     """
     Ensures that segments without voice in the waveform remain no longer than a 
     threshold determined by the VAD parameters in params.py.
 
     :param wav: the raw waveform as a numpy array of floats 
+    :param vad: "webrtc" (webrtcvad) or "energy" (energy_voice_flags)
     :return: the same waveform with silences trimmed away (length <= original wav length)
     """
     # Compute the voice detection window size
@@ -69,17 +108,12 @@ def trim_long_silences(wav):
     # Trim the end of the audio to have a multiple of the window size
     wav = wav[:len(wav) - (len(wav) % samples_per_window)]
     
-    # Convert the float waveform to 16-bit mono PCM
-    pcm_wave = struct.pack("%dh" % len(wav), *(np.round(wav * int16_max)).astype(np.int16))
-    
-    # Perform voice activation detection
-    voice_flags = []
-    vad = webrtcvad.Vad(mode=3)
-    for window_start in range(0, len(wav), samples_per_window):
-        window_end = window_start + samples_per_window
-        voice_flags.append(vad.is_speech(pcm_wave[window_start * 2:window_end * 2],
-                                         sample_rate=sampling_rate))
-    voice_flags = np.array(voice_flags)
+    if vad == "webrtc":
+        voice_flags = webrtc_voice_flags(wav, samples_per_window)
+    elif vad == "energy":
+        voice_flags = energy_voice_flags(wav, samples_per_window)
+    else:
+        raise ValueError("Unknown VAD %r, expected 'webrtc' or 'energy'" % vad)
     
     # Smooth the voice detection with a moving average
     def moving_average(array, width):
@@ -89,7 +123,7 @@ def trim_long_silences(wav):
         return ret[width - 1:] / width
     
     audio_mask = moving_average(voice_flags, vad_moving_average_width)
-    audio_mask = np.round(audio_mask).astype(np.bool)
+    audio_mask = np.round(audio_mask).astype(bool)
     
     # Dilate the voiced regions
     audio_mask = binary_dilation(audio_mask, np.ones(vad_max_silence_length + 1))
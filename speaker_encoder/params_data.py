@@ -22,6 +22,8 @@ vad_window_length = 30  # In milliseconds
 vad_moving_average_width = 8
 # Maximum number of consecutive silent frames a segment can have.
 vad_max_silence_length = 6
+# Energy VAD only: windows quieter than the loudest window by more than this are unvoiced (dB)
+vad_energy_threshold = -40
 
 
 ## Audio volume normalization
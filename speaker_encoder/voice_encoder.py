@@ -22,6 +22,13 @@ class SpeakerEncoder(nn.Module):
         self.linear = nn.Linear(model_hidden_size, model_embedding_size)
         self.relu = nn.ReLU()
         
+        # Mel front end (librosa.feature.melspectrogram of audio.wav_to_mel_spectrogram), kept 
+        # on the model device
+        self.n_fft = int(sampling_rate * mel_window_length / 1000)
+        self.hop_length = int(sampling_rate * mel_window_step / 1000)
+        self.register_buffer("window", torch.hann_window(self.n_fft), persistent=False)
+        self.register_buffer("mel_basis", torch.from_numpy(audio.mel_filterbank(self.n_fft)), persistent=False)
+        
         # Get the target device
         if device is None:
             device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -59,6 +66,26 @@ class SpeakerEncoder(nn.Module):
         embeds_raw = self.relu(self.linear(hidden[-1]))
         return embeds_raw / torch.norm(embeds_raw, dim=1, keepdim=True)
     
+    def mel_spectrograms(self, wavs: List[np.ndarray]):
+        """
+        Batched torch version of audio.wav_to_mel_spectrogram: the frames of every waveform 
+        (reflect-padded on its own, as librosa does) are taken as strided views, concatenated and 
+        go through a single FFT and mel projection on the model device.
+        
+        :param wavs: list of preprocessed waveforms as numpy arrays of floats, of any lengths
+        :return: list of the mel spectrograms of the waveforms as float32 tensors of shape 
+        (n_frames, mel_n_channels), views of one tensor
+        """
+        pad = self.n_fft // 2
+        frames = []
+        for wav in wavs:
+            wav = torch.as_tensor(wav, dtype=torch.float32, device=self.device)
+            wav = nn.functional.pad(wav.view(1, 1, -1), (pad, pad), mode="reflect").view(-1)
+            frames.append(wav.unfold(0, self.n_fft, self.hop_length))
+        spec = torch.fft.rfft(torch.cat(frames) * self.window).abs() ** 2
+        mels = torch.matmul(spec, self.mel_basis.T)
+        return mels.split([len(f) for f in frames])
+    
     @staticmethod
     def compute_partial_slices(n_samples: int, rate, min_coverage):
         """
@@ -112,13 +139,62 @@ class SpeakerEncoder(nn.Module):
         
         return wav_slices, mel_slices
     
+    def embed_utterances(self, wavs: List[np.ndarray], return_partials=False, rate=1.3, min_coverage=0.75):
+        """
+        Computes the embeddings of a batch of utterances, as embed_utterance does for each of them, 
+        with one mel front end pass (mel_spectrograms) and one forward pass over the partial 
+        utterances of all the utterances. The utterance embeddings are the L2-normed means 
+        of their partial embeddings, reduced per segment on the device.
+        
+        :param wavs: list of preprocessed utterance waveforms as numpy arrays of float32
+        :param return_partials, rate, min_coverage: see embed_utterance
+        :return: the embeddings as a numpy array of float32 of shape (len(wavs), 
+        model_embedding_size). If <return_partials> is True, also the list of the partial 
+        embeddings of each utterance as numpy arrays of float32 of shape 
+        (n_partials, model_embedding_size) and the list of their wav slices.
+        """
+        # Compute where to split each utterance into partials and pad the waveforms with zeros if 
+        # the partial utterances cover a larger range. 
+        all_wav_slices, all_mel_slices, padded_wavs = [], [], []
+        for wav in wavs:
+            wav_slices, mel_slices = self.compute_partial_slices(len(wav), rate, min_coverage)
+            max_wave_length = wav_slices[-1].stop
+            if max_wave_length >= len(wav):
+                wav = np.pad(wav, (0, max_wave_length - len(wav)), "constant")
+            all_wav_slices.append(wav_slices)
+            all_mel_slices.append(mel_slices)
+            padded_wavs.append(wav)
+        
+        # Split the utterances into partials and forward them all through the model at once. The 
+        # partials start every frame_step frames: windows of each spectrogram taken with unfold (a 
+        # strided view), copied once into the batch
+        samples_per_frame = int((sampling_rate * mel_window_step / 1000))
+        frame_step = int(np.round((sampling_rate / rate) / samples_per_frame))
+        n_partials = torch.tensor([len(mel_slices) for mel_slices in all_mel_slices], device=self.device)
+        with torch.no_grad():
+            mels = self.mel_spectrograms(padded_wavs)
+            partial_embeds = self(torch.cat([mel.unfold(0, partials_n_frames, frame_step)[:len(mel_slices)].transpose(1, 2)
+                                             for mel, mel_slices in zip(mels, all_mel_slices)]))
+            
+            # Mean of the partial embeddings of each utterance
+            segment_ids = torch.repeat_interleave(torch.arange(len(wavs), device=self.device), n_partials)
+            raw_embeds = torch.zeros(len(wavs), partial_embeds.size(1), device=self.device)
+            raw_embeds.index_add_(0, segment_ids, partial_embeds)
+            raw_embeds = raw_embeds / n_partials.unsqueeze(1)
+            embeds = raw_embeds / torch.norm(raw_embeds, dim=1, keepdim=True)
+        embeds = embeds.cpu().numpy()
+        
+        if return_partials:
+            partial_embeds = np.split(partial_embeds.cpu().numpy(), np.cumsum(n_partials.tolist())[:-1])
+            return embeds, partial_embeds, all_wav_slices
+        return embeds
+    
     def embed_utterance(self, wav: np.ndarray, return_partials=False, rate=1.3, min_coverage=0.75):
         """
         Computes an embedding for a single utterance. The utterance is divided in partial 
         utterances and an embedding is computed for each. The complete utterance embedding is the 
-        L2-normed average embedding of the partial utterances.
-        
-        TODO: independent batched version of this function
+        L2-normed average embedding of the partial utterances. See embed_utterances for a 
+        batched version.
     
         :param wav: a preprocessed utterance waveform as a numpy array of float32
         :param return_partials: if True, the partial embeddings will also be returned along with 
@@ -137,27 +213,10 @@ class SpeakerEncoder(nn.Module):
         (n_partials, model_embedding_size) and the wav partials as a list of slices will also be 
         returned.
         """
-        # Compute where to split the utterance into partials and pad the waveform with zeros if 
-        # the partial utterances cover a larger range. 
-        wav_slices, mel_slices = self.compute_partial_slices(len(wav), rate, min_coverage)
-        max_wave_length = wav_slices[-1].stop
-        if max_wave_length >= len(wav):
-            wav = np.pad(wav, (0, max_wave_length - len(wav)), "constant")
-        
-        # Split the utterance into partials and forward them through the model
-        mel = audio.wav_to_mel_spectrogram(wav)
-        mels = np.array([mel[s] for s in mel_slices])
-        with torch.no_grad():
-            mels = torch.from_numpy(mels).to(self.device)
-            partial_embeds = self(mels).cpu().numpy()
-        
-        # Compute the utterance embedding from the partial embeddings
-        raw_embed = np.mean(partial_embeds, axis=0)
-        embed = raw_embed / np.linalg.norm(raw_embed, 2)
-        
         if return_partials:
-            return embed, partial_embeds, wav_slices
-        return embed
+            embeds, partial_embeds, wav_slices = self.embed_utterances([wav], True, rate, min_coverage)
+            return embeds[0], partial_embeds[0], wav_slices[0]
+        return self.embed_utterances([wav], False, rate, min_coverage)[0]
     
     def embed_speaker(self, wavs: List[np.ndarray], **kwargs):
         """
@@ -165,9 +224,8 @@ class SpeakerEncoder(nn.Module):
         averaging their embedding and L2-normalizing it.
         
         :param wavs: list of wavs a numpy arrays of float32.
-        :param kwargs: extra arguments to embed_utterance()
+        :param kwargs: extra arguments to embed_utterances()
         :return: the embedding as a numpy array of float32 of shape (model_embedding_size,).
         """
-        raw_embed = np.mean([self.embed_utterance(wav, return_partials=False, **kwargs) \
-                             for wav in wavs], axis=0)
-        return raw_embed / np.linalg.norm(raw_embed, 2)
\ No newline at end of file
+        raw_embed = np.mean(self.embed_utterances(wavs, return_partials=False, **kwargs), axis=0)
+        return raw_embed / np.linalg.norm(raw_embed, 2)
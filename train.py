@@ -1,8 +1,12 @@
 import os
 import json
+import logging
 import argparse
 import itertools
 import math
+import contextlib
+import shutil
+import hashlib
 import torch
 from torch import nn, optim
 from torch.nn import functional as F
@@ -18,122 +22,448 @@ import utils
 from data_utils import (
   TextAudioSpeakerLoader,
   TextAudioSpeakerCollate,
-  DistributedBucketSampler
+  DistributedBucketSampler,
+  DistributedDynamicBucketSampler,
+  SRAugment,
+  enc_p_cache_path,
+  build_length_index
 )
 from models import (
   SynthesizerTrn,
   MultiPeriodDiscriminator,
+  compile_generator,
 )
 from losses import (
   generator_loss,
   discriminator_loss,
   feature_loss,
-  kl_loss
+  kl_loss,
+  SpectralLoss
 )
-from mel_processing import mel_spectrogram_torch, spec_to_mel_torch
+from mel_processing import MelFrontend
 
 torch.backends.cudnn.benchmark = True
 
 #os.environ['TORCH_DISTRIBUTED_DEBUG'] = 'INFO'
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+global_step = 0
 
 def main():
-  """Assume Single Node Multi GPUs Training Only"""
-  assert torch.cuda.is_available(), "CPU training is not allowed."
+  """Single node training: one process per GPU, or hps.train.world_size gloo processes on CPU"""
   hps = utils.get_hparams()
 
-  n_gpus = torch.cuda.device_count()
+  if get_device(0, hps).type == 'cuda':
+    n_gpus = torch.cuda.device_count()
+  else:
+    n_gpus = hps.train.world_size if "world_size" in hps.train else 1
   os.environ['MASTER_ADDR'] = 'localhost'
   os.environ['MASTER_PORT'] = hps.train.port
 
-  run(0, 1, hps)
-  # mp.spawn(run, nprocs=n_gpus, args=(n_gpus, hps,))
+  # the ranks only read the length indexes, none of them races to write one
+  for filelist in [hps.data.training_files, hps.data.validation_files]:
+    build_length_index(filelist, hps.data.hop_length)
 
+  if n_gpus > 1:
+    mp.spawn(run, nprocs=n_gpus, args=(n_gpus, hps,))
+  else:
+    run(0, 1, hps)
+
+
+def get_device(rank, hps):
+  """hps.train.device: "cuda", "cpu" or "auto" (default, cuda if available)"""
+  name = hps.train.device if "device" in hps.train else "auto"
+  if name == "auto":
+    name = "cuda" if torch.cuda.is_available() else "cpu"
+  if name == "cuda":
+    return torch.device("cuda", rank)
+  return torch.device(name)
+
+
+def cpu_bf16_supported():
+  try:
+    return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+  except (AttributeError, RuntimeError):
+    return False
+
+
+def train_autocast(hps, device, enabled=True):
+  """fp16 autocast on GPU (hps.train.fp16_run), bf16 autocast on CPU (hps.train.bf16_run, default on where supported)"""
+  if device.type == 'cuda':
+    return autocast(enabled=enabled and hps.train.fp16_run)
+  bf16_run = hps.train.bf16_run if "bf16_run" in hps.train else True
+  return torch.autocast('cpu', dtype=torch.bfloat16, enabled=enabled and bf16_run and cpu_bf16_supported())
+
+
+def enc_p_cached(hps):
+  """hps.train.cache_enc_p: train on cached enc_p outputs instead of WavLM features (enc_p must be frozen)"""
+  return "cache_enc_p" in hps.train and hps.train.cache_enc_p
+
+
+def build_enc_p_cache(hps, net_g, dataset, device):
+  """
+  Writes [m_p; logs_p] of every training utterance under model_dir/enc_p_cache, rebuilt when the enc_p weights change.
+  enc_p runs on the whole utterance, not on the training crop: see check_enc_p_cache.
+  """
+  cache_dir = os.path.join(hps.model_dir, "enc_p_cache")
+  enc_p = net_g.module.enc_p if hasattr(net_g, 'module') else net_g.enc_p
+  fingerprint = hashlib.sha1()
+  for v in enc_p.state_dict().values():
+    fingerprint.update(v.cpu().numpy().tobytes())
+  fingerprint = fingerprint.hexdigest()
+  fingerprint_path = os.path.join(cache_dir, "fingerprint")
+  if os.path.exists(fingerprint_path):
+    with open(fingerprint_path) as f:
+      if f.read() != fingerprint:
+        shutil.rmtree(cache_dir)
+  os.makedirs(cache_dir, exist_ok=True)
+  with open(fingerprint_path, "w") as f:
+    f.write(fingerprint)
+
+  n_written = 0
+  with torch.no_grad():
+    for audiopath in dataset.audiopaths:
+      c_filename = dataset.content_filename(audiopath[0])
+      path = enc_p_cache_path(cache_dir, c_filename)
+      if os.path.exists(path):
+        continue
+      c = torch.load(c_filename).squeeze(0).unsqueeze(0).to(device)
+      c_lengths = torch.LongTensor([c.size(-1)]).to(device)
+      _, m_p, logs_p, _ = enc_p(c, c_lengths)
+      torch.save(torch.cat([m_p, logs_p], 1)[0].cpu(), path + ".tmp")
+      os.replace(path + ".tmp", path)
+      n_written += 1
+  return cache_dir, n_written
 
-def run(rank, n_gpus, hps):
 
+def check_enc_p_cache(hps, net_g, dataset, device, n_items=8):
+  """
+  Compares the cached [m_p; logs_p] with enc_p run live on a training crop of the same items.
+  The cache runs enc_p over whole utterances, while training without it runs enc_p on the
+  max_speclen-frame crop; enc_p's WN stack sees about +-64 frames, so the cached stats near
+  the crop edges differ and the KL target changes. Returns the max and mean |diff| of m_p
+  and logs_p over n_items random crops.
+  """
+  cache_dir = os.path.join(hps.model_dir, "enc_p_cache")
+  enc_p = net_g.module.enc_p if hasattr(net_g, 'module') else net_g.enc_p
+  g = torch.Generator().manual_seed(1234)
+  diffs = {"m_p": [], "logs_p": []}
+  with torch.no_grad():
+    for idx in torch.randperm(len(dataset.audiopaths), generator=g)[:n_items].tolist():
+      c_filename = dataset.content_filename(dataset.audiopaths[idx][0])
+      c = torch.load(c_filename).squeeze(0)
+      seglen = min(c.size(-1), hps.train.max_speclen)
+      start = int(torch.randint(0, c.size(-1) - seglen + 1, (1,), generator=g))
+      c = c[:, start:start+seglen].unsqueeze(0).to(device)
+      _, m_p, logs_p, _ = enc_p(c, torch.LongTensor([seglen]).to(device))
+      cached = torch.load(enc_p_cache_path(cache_dir, c_filename))[:, start:start+seglen].unsqueeze(0).to(device)
+      m_p_cached, logs_p_cached = torch.split(cached, m_p.size(1), dim=1)
+      diffs["m_p"].append((m_p - m_p_cached).abs().flatten())
+      diffs["logs_p"].append((logs_p - logs_p_cached).abs().flatten())
+  return {k: (torch.cat(v).max().item(), torch.cat(v).mean().item()) for k, v in diffs.items()}
+
+
+def run(rank, n_gpus, hps):
+  global global_step
   if rank == 0:
     logger = utils.get_logger(hps.model_dir)
     logger.info(hps)
     utils.check_git_hash(hps.model_dir)
     writer = SummaryWriter(log_dir=hps.model_dir)
     writer_eval = SummaryWriter(log_dir=os.path.join(hps.model_dir, "eval"))
+    # checkpoint writes and summaries (matplotlib) run off the training loop
+    worker = utils.BackgroundWorker()
+  else:
+    # only rank 0 reports; other ranks keep warnings and errors
+    logging.getLogger().setLevel(logging.WARNING)
+    worker = None
 
+  device = get_device(rank, hps)
   if n_gpus > 1:
-      dist.init_process_group(backend='nccl', init_method='env://', world_size=n_gpus, rank=rank)
+    backend = 'nccl' if device.type == 'cuda' else 'gloo'
+    dist.init_process_group(backend=backend, init_method='env://', world_size=n_gpus, rank=rank)
   torch.manual_seed(hps.train.seed)
-  torch.cuda.set_device(rank)
+  if device.type == 'cuda':
+    torch.cuda.set_device(rank)
+  else:
+    # by default share the cores between the CPU processes instead of oversubscribing them
+    num_threads = hps.train.num_threads if "num_threads" in hps.train else max(1, (os.cpu_count() or 1) // n_gpus)
+    torch.set_num_threads(num_threads)
 
   train_dataset = TextAudioSpeakerLoader(hps.data.training_files, hps)
-  train_sampler = DistributedBucketSampler(
-      train_dataset,
-      hps.train.batch_size,
-      [32,300,400,500,600,700,800,900,1000],
-      num_replicas=n_gpus,
-      rank=rank,
-      shuffle=True)
+  boundaries = list(hps.train.boundaries) if "boundaries" in hps.train else [32,300,400,500,600,700,800,900,1000]
+  if "max_frames_per_batch" in hps.train:
+    # batch size adapts to the cropped lengths of the items; the collate crops them to max_speclen+1 frames
+    train_sampler = DistributedDynamicBucketSampler(
+        train_dataset,
+        hps.train.max_frames_per_batch,
+        boundaries,
+        num_replicas=n_gpus,
+        rank=rank,
+        shuffle=True,
+        max_len=hps.train.max_speclen + 1)
+  else:
+    train_sampler = DistributedBucketSampler(
+        train_dataset,
+        hps.train.batch_size,
+        boundaries,
+        num_replicas=n_gpus,
+        rank=rank,
+        shuffle=True)
+  sr_augment = None
+  if hps.train.use_sr:
+    # the content input of every training batch is recomputed from its SR-augmented audio
+    assert not enc_p_cached(hps), "use_sr changes the enc_p input, it can not be combined with cache_enc_p"
+    chunk_seconds = hps.train.sr_chunk_seconds if "sr_chunk_seconds" in hps.train else None
+    sr_augment = SRAugment(utils.get_vocoder(rank), utils.get_cmodel(rank), hps.data.sampling_rate, hps.data.hop_length,
+        chunk_seconds=chunk_seconds).to(device)
+    train_dataset.load_content = False
   collate_fn = TextAudioSpeakerCollate(hps)
-  train_loader = DataLoader(train_dataset, num_workers=0, shuffle=False, pin_memory=True,
+  train_loader = DataLoader(train_dataset, num_workers=0, shuffle=False, pin_memory=device.type == 'cuda',
       collate_fn=collate_fn, batch_sampler=train_sampler)
   if rank == 0:
     eval_dataset = TextAudioSpeakerLoader(hps.data.validation_files, hps)
-    eval_loader = DataLoader(eval_dataset, num_workers=0, shuffle=True,
-        batch_size=hps.train.batch_size, pin_memory=False,
-        drop_last=False, collate_fn=collate_fn)
+    # whole utterances, one at a time and always the same ones (the filelist order is shuffled with a
+    # fixed seed), so the eval metric that ranks the checkpoints is comparable between evaluations
+    # bounded: rank 0 runs infer on each of them while the other ranks wait at the next collective
+    n_eval = min(hps.train.eval_max_items if "eval_max_items" in hps.train else 8, len(eval_dataset))
+    eval_loader = DataLoader(torch.utils.data.Subset(eval_dataset, range(n_eval)), num_workers=0, shuffle=False,
+        batch_size=None, pin_memory=False)
 
   net_g = SynthesizerTrn(
       hps.data.filter_length // 2 + 1,
       hps.train.segment_size // hps.data.hop_length,
-      **hps.model).cuda(rank)
-  net_d = MultiPeriodDiscriminator(hps.model.use_spectral_norm).cuda(rank)
+      **hps.model).to(device)
+  fused_discriminator = hps.train.fused_discriminator if "fused_discriminator" in hps.train else False
+  net_d = MultiPeriodDiscriminator(hps.model.use_spectral_norm, fused_forward=fused_discriminator).to(device)
+  # adaptation mode: frozen parameters get no gradients and no optimizer state
+  freeze_g = list(hps.train.freeze) if "freeze" in hps.train else []
+  freeze_d = list(hps.train.freeze_d) if "freeze_d" in hps.train else []
+  assert not enc_p_cached(hps) or "enc_p" in freeze_g, "cache_enc_p needs enc_p in hps.train.freeze"
+  for net, prefixes, name in [(net_g, freeze_g, "G"), (net_d, freeze_d, "D")]:
+    n_frozen, n_total = commons.freeze_parameters(net, prefixes)
+    if rank == 0 and prefixes:
+      logger.info("{}: froze {} of {} parameters ({})".format(name, n_frozen, n_total, ", ".join(prefixes)))
+  if "grad_checkpoint" in hps.train and hps.train.grad_checkpoint:
+    # WN layers and HiFi-GAN resblocks recompute their activations in the backward pass
+    n_modules = commons.set_gradient_checkpointing(net_g)
+    if rank == 0:
+      logger.info("Gradient checkpointing on {} modules".format(n_modules))
+  if "compile" in hps.train and hps.train.compile:
+    # the first steps (and evaluation, for infer) pay the compilation time
+    compile_generator(net_g)
+  mel_frontend = MelFrontend.from_hparams(hps.data).to(device)
+  stft_resolutions = hps.train.stft_resolutions if "stft_resolutions" in hps.train else []
+  spectral_loss = SpectralLoss(mel_frontend, stft_resolutions).to(device)
   optim_g = torch.optim.AdamW(
-      net_g.parameters(), 
+      [p for p in net_g.parameters() if p.requires_grad],
       hps.train.learning_rate, 
       betas=hps.train.betas, 
       eps=hps.train.eps)
   optim_d = torch.optim.AdamW(
-      net_d.parameters(),
+      [p for p in net_d.parameters() if p.requires_grad],
       hps.train.learning_rate, 
       betas=hps.train.betas, 
       eps=hps.train.eps)
   if n_gpus > 1:
-      net_g = DDP(net_g, device_ids=[rank])
-  else:
-      net_g = net_g.to(device)
+    device_ids = [rank] if device.type == 'cuda' else None
+    net_g = DDP(net_g, device_ids=device_ids)
+    net_d = DDP(net_d, device_ids=device_ids)
 
-  if n_gpus > 1:
-      net_d = DDP(net_d, device_ids=[rank])
+  keep_last = hps.train.keep_last_checkpoints if "keep_last_checkpoints" in hps.train else 3
+  keep_best = hps.train.keep_best_checkpoints if "keep_best_checkpoints" in hps.train else 1
+  checkpoints = utils.CheckpointManager(hps.model_dir, keep_last, keep_best, worker)
+  latest = checkpoints.latest()
+  if latest is not None:
+    _, _, _, iteration = utils.load_checkpoint(latest["G"], net_g, optim_g)
+    _, _, _, _ = utils.load_checkpoint(latest["D"], net_d, optim_d)
+    if checkpoints.latest_is_legacy():
+      # written at the end of epoch `iteration` by the epoch-based training
+      epoch_str = iteration + 1
+      global_step = iteration * len(train_loader)
+      if rank == 0:
+        logger.warning("{} stores an epoch, not a global step: resuming at epoch {}, "
+                       "global step restarted at {} (epochs x current batches per epoch)".format(latest["G"], epoch_str, global_step))
+    else:
+      # checkpoints are written after step `iteration`
+      global_step = iteration + 1
+      epoch_str = global_step // len(train_loader) + 1
   else:
-      net_d = net_d.to(device)
-
-  try:
-    _, _, _, _ = utils.load_checkpoint(utils.latest_checkpoint_path(hps.model_dir, "G_*.pth"), net_g, optim_g)
-    _, _, _, _ = utils.load_checkpoint(utils.latest_checkpoint_path(hps.model_dir, "D_*.pth"), net_d, optim_d)
-  except:
     # Load pretrained models
     pretrained_g_path = "checkpoints/freevc.pth"
     pretrained_d_path = "checkpoints/D-freevc.pth"
-    _, _, _, _ = utils.load_checkpoint(pretrained_g_path, net_g, optim_g)
-    _, _, _, _ = utils.load_checkpoint(pretrained_d_path, net_d, optim_d)
+    # the pretrained optimizer state covers every parameter, so it only fits when nothing is frozen
+    _, _, _, _ = utils.load_checkpoint(pretrained_g_path, net_g, None if freeze_g else optim_g)
+    _, _, _, _ = utils.load_checkpoint(pretrained_d_path, net_d, None if freeze_d else optim_d)
+    global_step = 0
+    epoch_str = 1
 
-  epoch_str = 1
+  if enc_p_cached(hps):
+    if rank == 0:
+      cache_dir, n_written = build_enc_p_cache(hps, net_g, train_dataset, device)
+      logger.info("enc_p cache: {} ({} new entries)".format(cache_dir, n_written))
+      diffs = check_enc_p_cache(hps, net_g, train_dataset, device)
+      logger.warning("enc_p cache: stats of whole utterances, not of the training crop; |cached - live| on a batch of crops: "
+                     "m_p max {:.3g} mean {:.3g}, logs_p max {:.3g} mean {:.3g}".format(*diffs["m_p"], *diffs["logs_p"]))
+    if n_gpus > 1:
+      dist.barrier()
+    train_dataset.enc_p_cache_dir = os.path.join(hps.model_dir, "enc_p_cache")
 
   scheduler_g = torch.optim.lr_scheduler.ExponentialLR(optim_g, gamma=hps.train.lr_decay, last_epoch=epoch_str-2)
   scheduler_d = torch.optim.lr_scheduler.ExponentialLR(optim_d, gamma=hps.train.lr_decay, last_epoch=epoch_str-2)
 
-  scaler = GradScaler(enabled=hps.train.fp16_run)
+  scaler = GradScaler(enabled=hps.train.fp16_run and device.type == 'cuda')
 
   for epoch in range(epoch_str, hps.train.epochs + 1):
     if rank==0:
-      train_and_evaluate(rank, epoch, hps, [net_g, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, [train_loader, eval_loader], logger, [writer, writer_eval])
+      train_and_evaluate(rank, epoch, hps, [net_g, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, spectral_loss, [train_loader, eval_loader], logger, [writer, writer_eval], worker, checkpoints, sr_augment)
     else:
-      train_and_evaluate(rank, epoch, hps, [net_g, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, [train_loader, None], None, None)
+      train_and_evaluate(rank, epoch, hps, [net_g, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, spectral_loss, [train_loader, None], None, None, None, None, sr_augment)
     scheduler_g.step()
     scheduler_d.step()
 
+  if rank == 0:
+    worker.close()
+
+  if n_gpus > 1:
+    dist.destroy_process_group()
+
 
-def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, loaders, logger, writers):
-  
+def split_batch(items, n):
+  """Splits a collated batch into (at most) n micro-batches along the batch dimension"""
+  if n == 1:
+    return [items]
+  return list(zip(*[torch.chunk(x, n) for x in items]))
+
+
+def get_rng_state(device):
+  return torch.get_rng_state(), torch.cuda.get_rng_state(device) if device.type == 'cuda' else None
+
+
+def set_rng_state(state, device):
+  cpu_state, cuda_state = state
+  torch.set_rng_state(cpu_state)
+  if cuda_state is not None:
+    torch.cuda.set_rng_state(cuda_state, device)
+
+
+def no_sync(net, enabled=True):
+  """DDP.no_sync(): keep this backward's gradients local (no-op for unwrapped models)"""
+  if enabled and hasattr(net, 'no_sync'):
+    return net.no_sync()
+  return contextlib.nullcontext()
+
+
+def generator_forward(hps, net_g, spectral_loss, items, device):
+  """Runs the generator on a micro-batch and slices the matching targets"""
+  mel_frontend = spectral_loss.mel_frontend
+  if hps.model.use_spk:
+    c, spec, y, spk = items
+    g = spk.to(device, non_blocking=True)
+  else:
+    c, spec, y = items
+    g = None
+  spec, y = spec.to(device, non_blocking=True), y.to(device, non_blocking=True)
+  c = c.to(device, non_blocking=True)
+  mel = mel_frontend.spec_to_mel(spec)
+  p_stats = None
+  if enc_p_cached(hps):
+    # the loader returned the cached [m_p; logs_p] of the frozen enc_p in place of c
+    c, p_stats = None, c
+
+  with train_autocast(hps, device):
+    y_hat, ids_slice, z_mask,\
+    (z, z_p, m_p, logs_p, m_q, logs_q) = net_g(c, spec, g=g, mel=mel, p_stats=p_stats)
+    
+    y_mel = commons.slice_segments(mel, ids_slice, hps.train.segment_size // hps.data.hop_length)
+    y_spec = None
+    if len(spectral_loss.frontends) > 0:
+      y_spec = commons.slice_segments(spec, ids_slice, hps.train.segment_size // hps.data.hop_length)
+    y = commons.slice_segments(y, ids_slice * hps.data.hop_length, hps.train.segment_size) # slice 
+  return {
+    "y": y, "y_hat": y_hat, "z_mask": z_mask, "z_p": z_p, "m_p": m_p, "logs_p": logs_p, "logs_q": logs_q,
+    "mel": mel, "y_mel": y_mel, "y_spec": y_spec,
+  }
+
+
+def train_step(rank, hps, nets, optims, scaler, spectral_loss, items):
+  """
+  One discriminator and one generator update on a collated batch. Returns the tensors used for logging.
+
+  With hps.train.grad_accum_steps > 1 the batch is split into micro-batches whose gradients are accumulated:
+  first D over every micro-batch and one D step, then G (rerun with the RNG state of the D pass, so it
+  produces the same y_hat) against the updated D and one G step, as for the whole batch at once.
+  Only one micro-batch's activations are alive at a time. Logged values are those of the last micro-batch.
+  """
+  net_g, net_d = nets
+  optim_g, optim_d = optims
+  device = get_device(rank, hps)
+  accum_steps = hps.train.grad_accum_steps if "grad_accum_steps" in hps.train else 1
+  micro_batches = split_batch(items, accum_steps)
+  batch_size = items[0].size(0)
+  # a single micro-batch keeps its generator graph for the G update instead of rerunning the generator
+  keep_graph = len(micro_batches) == 1
+
+  optim_d.zero_grad()
+  fwds, rng_states = [], []
+  for i, micro_batch in enumerate(micro_batches):
+    weight = micro_batch[0].size(0) / batch_size
+    rng_states.append(get_rng_state(device))
+    with torch.set_grad_enabled(keep_graph):
+      fwd = generator_forward(hps, net_g, spectral_loss, micro_batch, device)
+    fwds.append(fwd if keep_graph else None)
+
+    with no_sync(net_d, i < len(micro_batches) - 1):
+      with train_autocast(hps, device):
+        # Discriminator
+        y_d_hat_r, y_d_hat_g, _, _ = net_d(fwd["y"], fwd["y_hat"].detach())
+        with train_autocast(hps, device, enabled=False):
+          loss_disc, losses_disc_r, losses_disc_g = discriminator_loss(y_d_hat_r, y_d_hat_g)
+          loss_disc_all = loss_disc
+      scaler.scale(loss_disc_all * weight).backward()
+  scaler.unscale_(optim_d)
+  grad_norm_d = commons.grad_norm(net_d.parameters())
+  scaler.step(optim_d)
+
+  optim_g.zero_grad()
+  for i, micro_batch in enumerate(micro_batches):
+    weight = micro_batch[0].size(0) / batch_size
+    # the discriminator gradients of the generator loss are discarded, so they are never all-reduced
+    with no_sync(net_g, i < len(micro_batches) - 1), no_sync(net_d):
+      if keep_graph:
+        fwd = fwds[i]
+      else:
+        set_rng_state(rng_states[i], device)
+        fwd = generator_forward(hps, net_g, spectral_loss, micro_batch, device)
+      with train_autocast(hps, device):
+        # Generator
+        y_d_hat_r, y_d_hat_g, fmap_r, fmap_g = net_d(fwd["y"], fwd["y_hat"])
+        with train_autocast(hps, device, enabled=False):
+          # one STFT of y_hat feeds both the mel loss and the optional STFT loss
+          loss_mel, loss_stft, y_hat_mel = spectral_loss(fwd["y_hat"].float(), fwd["y_mel"], fwd["y_spec"], fwd["y"].float())
+          loss_mel = loss_mel * hps.train.c_mel
+          if len(spectral_loss.frontends) > 0:
+            loss_stft = loss_stft * (hps.train.c_stft if "c_stft" in hps.train else 1.0)
+          loss_kl = kl_loss(fwd["z_p"], fwd["logs_q"], fwd["m_p"], fwd["logs_p"], fwd["z_mask"]) * hps.train.c_kl
+          loss_fm = feature_loss(fmap_r, fmap_g)
+          loss_gen, losses_gen = generator_loss(y_d_hat_g)
+          loss_gen_all = loss_gen + loss_fm + loss_mel + loss_kl + loss_stft
+      scaler.scale(loss_gen_all * weight).backward()
+  scaler.unscale_(optim_g)
+  grad_norm_g = commons.grad_norm(net_g.parameters())
+  scaler.step(optim_g)
+  scaler.update()
+
+  return {
+    "loss_disc": loss_disc, "loss_disc_all": loss_disc_all,
+    "losses_disc_r": losses_disc_r, "losses_disc_g": losses_disc_g,
+    "loss_gen": loss_gen, "loss_gen_all": loss_gen_all, "losses_gen": losses_gen,
+    "loss_fm": loss_fm, "loss_mel": loss_mel, "loss_kl": loss_kl, "loss_stft": loss_stft,
+    "grad_norm_d": grad_norm_d, "grad_norm_g": grad_norm_g,
+    "mel": fwd["mel"], "y_mel": fwd["y_mel"], "y_hat_mel": y_hat_mel,
+  }
+
+
+def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, spectral_loss, loaders, logger, writers, worker, checkpoints, sr_augment=None):
+  """log_interval and eval_interval count global steps; summaries and checkpoints are written by the worker thread"""
   net_g, net_d = nets
   optim_g, optim_d = optims
   scheduler_g, scheduler_d = schedulers
@@ -142,157 +472,114 @@ def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, loade
     writer, writer_eval = writers
 
   train_loader.batch_sampler.set_epoch(epoch)
+  global global_step
 
   net_g.train()
   net_d.train()
   for batch_idx, items in enumerate(train_loader):
-    if hps.model.use_spk:
-      c, spec, y, spk = items
-      g = spk.cuda(rank, non_blocking=True)
-    else:
-      c, spec, y = items
-      g = None
-    spec, y = spec.cuda(rank, non_blocking=True), y.cuda(rank, non_blocking=True)
-    c = c.cuda(rank, non_blocking=True)
-    mel = spec_to_mel_torch(
-          spec, 
-          hps.data.filter_length, 
-          hps.data.n_mel_channels, 
-          hps.data.sampling_rate,
-          hps.data.mel_fmin, 
-          hps.data.mel_fmax)
-
-    with autocast(enabled=hps.train.fp16_run):
-      y_hat, ids_slice, z_mask,\
-      (z, z_p, m_p, logs_p, m_q, logs_q) = net_g(c, spec, g=g, mel=mel)
-      
-      y_mel = commons.slice_segments(mel, ids_slice, hps.train.segment_size // hps.data.hop_length)
-      y_hat_mel = mel_spectrogram_torch(
-          y_hat.squeeze(1), 
-          hps.data.filter_length, 
-          hps.data.n_mel_channels, 
-          hps.data.sampling_rate, 
-          hps.data.hop_length, 
-          hps.data.win_length, 
-          hps.data.mel_fmin, 
-          hps.data.mel_fmax
-      )
-      y = commons.slice_segments(y, ids_slice * hps.data.hop_length, hps.train.segment_size) # slice 
-
-      # Discriminator
-      y_d_hat_r, y_d_hat_g, _, _ = net_d(y, y_hat.detach())
-      with autocast(enabled=False):
-        loss_disc, losses_disc_r, losses_disc_g = discriminator_loss(y_d_hat_r, y_d_hat_g)
-        loss_disc_all = loss_disc
-    optim_d.zero_grad()
-    scaler.scale(loss_disc_all).backward()
-    scaler.unscale_(optim_d)
-    grad_norm_d = commons.clip_grad_value_(net_d.parameters(), None)
-    scaler.step(optim_d)
-
-    with autocast(enabled=hps.train.fp16_run):
-      # Generator
-      y_d_hat_r, y_d_hat_g, fmap_r, fmap_g = net_d(y, y_hat)
-      with autocast(enabled=False):
-        loss_mel = F.l1_loss(y_mel, y_hat_mel) * hps.train.c_mel
-        loss_kl = kl_loss(z_p, logs_q, m_p, logs_p, z_mask) * hps.train.c_kl
-        loss_fm = feature_loss(fmap_r, fmap_g)
-        loss_gen, losses_gen = generator_loss(y_d_hat_g)
-        loss_gen_all = loss_gen + loss_fm + loss_mel + loss_kl
-    optim_g.zero_grad()
-    scaler.scale(loss_gen_all).backward()
-    scaler.unscale_(optim_g)
-    grad_norm_g = commons.clip_grad_value_(net_g.parameters(), None)
-    scaler.step(optim_g)
-    scaler.update()
+    if sr_augment is not None:
+      y = items[2].to(get_device(rank, hps), non_blocking=True)
+      items = (sr_augment(y), items[1], y) + tuple(items[3:])
+    out = train_step(rank, hps, nets, optims, scaler, spectral_loss, items)
+
+    if rank==0:
+      if global_step % hps.train.log_interval == 0:
+        lr = optim_g.param_groups[0]['lr']
+        losses = [out["loss_disc"], out["loss_gen"], out["loss_fm"], out["loss_mel"], out["loss_kl"]]
+        logger.info('Train Epoch: {} [{:.0f}%]'.format(
+          epoch,
+          100. * batch_idx / len(train_loader)))
+        logger.info(torch.stack(losses).tolist() + [global_step, lr])
+        
+        scalar_dict = {"loss/g/total": out["loss_gen_all"], "loss/d/total": out["loss_disc_all"], "learning_rate": lr, "grad_norm_d": out["grad_norm_d"], "grad_norm_g": out["grad_norm_g"]}
+        scalar_dict.update({"loss/g/fm": out["loss_fm"], "loss/g/mel": out["loss_mel"], "loss/g/kl": out["loss_kl"]})
+        if len(spectral_loss.frontends) > 0:
+          scalar_dict.update({"loss/g/stft": out["loss_stft"]})
+
+        scalar_dict.update({"loss/g/{}".format(i): v for i, v in enumerate(out["losses_gen"].tolist())})
+        scalar_dict.update({"loss/d_r/{}".format(i): v for i, v in enumerate(out["losses_disc_r"].tolist())})
+        scalar_dict.update({"loss/d_g/{}".format(i): v for i, v in enumerate(out["losses_disc_g"].tolist())})
+        # plain floats and numpy copies, so the worker holds no reference to the autograd graph
+        scalar_dict = {k: float(v) for k, v in scalar_dict.items()}
+        spectrograms = { 
+            "slice/mel_org": out["y_mel"][0].data.cpu().numpy().copy(),
+            "slice/mel_gen": out["y_hat_mel"][0].data.cpu().numpy().copy(), 
+            "all/mel": out["mel"][0].data.cpu().numpy().copy(),
+        }
+        worker.submit(utils.summarize_spectrograms,
+          writer=writer,
+          global_step=global_step, 
+          spectrograms=spectrograms,
+          scalars=scalar_dict)
+
+      # nothing to evaluate or save before the first step
+      if global_step % hps.train.eval_interval == 0 and global_step > 0:
+        loss_mel_eval = evaluate(hps, net_g, spectral_loss, eval_loader, writer_eval, worker)
+        checkpoints.save(global_step, {"G": (net_g, optim_g), "D": (net_d, optim_d)}, hps.train.learning_rate, metric=loss_mel_eval)
+    global_step += 1
 
   if rank==0:
     logger.info('====> Epoch: {}'.format(epoch))
-    if epoch % hps.train.log_interval == 0:
-      lr = optim_g.param_groups[0]['lr']
-      losses = [loss_disc, loss_gen, loss_fm, loss_mel, loss_kl]
-      logger.info('Train Epoch: {} [{:.0f}%]'.format(
-        epoch,
-        100. * batch_idx / len(train_loader)))
-      logger.info([x.item() for x in losses] + [epoch, lr])
-      
-      scalar_dict = {"loss/g/total": loss_gen_all, "loss/d/total": loss_disc_all, "learning_rate": lr, "grad_norm_d": grad_norm_d, "grad_norm_g": grad_norm_g}
-      scalar_dict.update({"loss/g/fm": loss_fm, "loss/g/mel": loss_mel, "loss/g/kl": loss_kl})
-
-      scalar_dict.update({"loss/g/{}".format(i): v for i, v in enumerate(losses_gen)})
-      scalar_dict.update({"loss/d_r/{}".format(i): v for i, v in enumerate(losses_disc_r)})
-      scalar_dict.update({"loss/d_g/{}".format(i): v for i, v in enumerate(losses_disc_g)})
-      image_dict = { 
-          "slice/mel_org": utils.plot_spectrogram_to_numpy(y_mel[0].data.cpu().numpy()),
-          "slice/mel_gen": utils.plot_spectrogram_to_numpy(y_hat_mel[0].data.cpu().numpy()), 
-          "all/mel": utils.plot_spectrogram_to_numpy(mel[0].data.cpu().numpy()),
-      }
-      utils.summarize(
-        writer=writer,
-        global_step=epoch, 
-        images=image_dict,
-        scalars=scalar_dict)
-
-    if epoch % hps.train.eval_interval == 0:
-      evaluate(hps, net_g, eval_loader, writer_eval, epoch)
-      utils.save_checkpoint(net_g, optim_g, hps.train.learning_rate, epoch, os.path.join(hps.model_dir, "G_{}.pth".format(epoch)))
-      utils.save_checkpoint(net_d, optim_d, hps.train.learning_rate, epoch, os.path.join(hps.model_dir, "D_{}.pth".format(epoch)))
+    crop_efficiency = getattr(train_loader.batch_sampler, "crop_efficiency", None)
+    if crop_efficiency is not None:
+      logger.info('Crop efficiency (fed / available frames): {:.3f}'.format(crop_efficiency))
+      worker.submit(writer.add_scalar, "data/crop_efficiency", crop_efficiency, epoch)
   
     
 
  
-def evaluate(hps, generator, eval_loader, writer_eval, epoch):
+def evaluate(hps, generator, spectral_loss, eval_loader, writer_eval, worker):
+    """
+    Mel L1 of the generator on eval data, through the training SpectralLoss (same STFT and filterbank),
+    averaged over the utterances of eval_loader (unbatched, whole utterances). The first one is summarized.
+    """
+    mel_frontend = spectral_loss.mel_frontend
 
+    device = get_device(0, hps)
     generator.eval()
-    with torch.no_grad():
+    losses = {"loss/mel": [], "loss/stft": []}
+    # the prior noise of infer() comes from a fixed seed, without touching the training RNG state
+    with torch.no_grad(), torch.random.fork_rng(devices=[device.index] if device.type == 'cuda' else []):
+      torch.manual_seed(hps.train.seed)
       for batch_idx, items in enumerate(eval_loader):
+        items = [x.unsqueeze(0).to(device) for x in items]
         if hps.model.use_spk:
-          c, spec, y, spk = items
-          g = spk[:1].cuda(0)
+          c, spec, y, g = items
         else:
           c, spec, y = items
           g = None
-        spec, y = spec[:1].cuda(0), y[:1].cuda(0)
-        c = c[:1].cuda(0)
-        break
-      mel = spec_to_mel_torch(
-        spec, 
-        hps.data.filter_length, 
-        hps.data.n_mel_channels, 
-        hps.data.sampling_rate,
-        hps.data.mel_fmin, 
-        hps.data.mel_fmax)
-      if hasattr(generator, 'module'):
-          y_hat = generator.module.infer(c, g=g, mel=mel)
-      else:
-          y_hat = generator.infer(c, g=g, mel=mel)
-      
-      y_hat_mel = mel_spectrogram_torch(
-        y_hat.squeeze(1).float(),
-        hps.data.filter_length,
-        hps.data.n_mel_channels,
-        hps.data.sampling_rate,
-        hps.data.hop_length,
-        hps.data.win_length,
-        hps.data.mel_fmin,
-        hps.data.mel_fmax
-      )
-    image_dict = {
-      "gen/mel": utils.plot_spectrogram_to_numpy(y_hat_mel[0].cpu().numpy()),
-      "gt/mel": utils.plot_spectrogram_to_numpy(mel[0].cpu().numpy())
-    }
-    audio_dict = {
-      "gen/audio": y_hat[0],
-      "gt/audio": y[0]
-    }
-    utils.summarize(
+        mel = mel_frontend.spec_to_mel(spec)
+        if hasattr(generator, 'module'):
+            y_hat = generator.module.infer(c, g=g, mel=mel)
+        else:
+            y_hat = generator.infer(c, g=g, mel=mel)
+
+        frames = min(mel.size(-1), y_hat.size(-1) // hps.data.hop_length)
+        samples = frames * hps.data.hop_length
+        loss_mel, loss_stft, y_hat_mel = spectral_loss(y_hat[..., :samples].float(), mel[..., :frames], spec[..., :frames], y[..., :samples])
+        losses["loss/mel"].append(loss_mel.item())
+        if len(spectral_loss.frontends) > 0:
+          losses["loss/stft"].append(loss_stft.item())
+        if batch_idx == 0:
+          spectrograms = {
+            "gen/mel": y_hat_mel[0].cpu().numpy(),
+            "gt/mel": mel[0, :, :frames].cpu().numpy()
+          }
+          audio_dict = {
+            "gen/audio": y_hat[0].cpu(),
+            "gt/audio": y[0].cpu()
+          }
+    scalars = {k: sum(v) / len(v) for k, v in losses.items() if len(v) > 0}
+    worker.submit(utils.summarize_spectrograms,
       writer=writer_eval,
-      global_step=epoch, 
-      images=image_dict,
+      global_step=global_step, 
+      spectrograms=spectrograms,
+      scalars=scalars,
       audios=audio_dict,
       audio_sampling_rate=hps.data.sampling_rate
     )
     generator.train()
+    return scalars["loss/mel"]
 
                            
 if __name__ == "__main__":
@@ -5,6 +5,8 @@ import argparse
 import logging
 import json
 import subprocess
+import queue
+import threading
 import numpy as np
 from scipy.io.wavfile import read
 import torch
@@ -29,9 +31,10 @@ def get_cmodel(rank):
     return cmodel
     
     
-def get_content(cmodel, y):
+def get_content(cmodel, y, padding_mask=None):
+    """padding_mask: [b, t] bool, True on the zero padding of a batch of different-length wavs"""
     with torch.no_grad():
-        c = cmodel.extract_features(y.squeeze(1))[0]
+        c = cmodel.extract_features(y.squeeze(1), padding_mask=padding_mask)[0]
     c = c.transpose(1, 2)
     return c
 
@@ -96,17 +99,79 @@ def load_checkpoint(checkpoint_path, model, optimizer=None, strict=False):
   return model, optimizer, learning_rate, iteration
 
 
-def save_checkpoint(model, optimizer, learning_rate, iteration, checkpoint_path):
-  logger.info("Saving model and optimizer state at iteration {} to {}".format(
-    iteration, checkpoint_path))
+class BackgroundWorker:
+  """Runs jobs one at a time, in submission order, on a daemon thread. A failed job is re-raised by the next submit() or flush()."""
+  def __init__(self, max_pending=8):
+    # bounded, so a slow disk applies backpressure instead of piling up state snapshots
+    self.jobs = queue.Queue(max_pending)
+    self.error = None
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def _run(self):
+    while True:
+      job = self.jobs.get()
+      try:
+        if job is None:
+          return
+        fn, args, kwargs = job
+        fn(*args, **kwargs)
+      except Exception as e:
+        logger.exception("Background job failed")
+        self.error = e
+      finally:
+        self.jobs.task_done()
+
+  def _raise(self):
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise error
+
+  def submit(self, fn, *args, **kwargs):
+    self._raise()
+    self.jobs.put((fn, args, kwargs))
+
+  def flush(self):
+    self.jobs.join()
+    self._raise()
+
+  def close(self):
+    self.flush()
+    self.jobs.put(None)
+    self.thread.join()
+
+
+def to_cpu(obj):
+  """Copies the tensors of a (nested) state dict to the CPU, unaffected by later in-place updates"""
+  if torch.is_tensor(obj):
+    return obj.detach().to('cpu', copy=True)
+  if isinstance(obj, dict):
+    return {k: to_cpu(v) for k, v in obj.items()}
+  if isinstance(obj, (list, tuple)):
+    return type(obj)(to_cpu(v) for v in obj)
+  return obj
+
+
+def checkpoint_state(model, optimizer, learning_rate, iteration):
   if hasattr(model, 'module'):
     state_dict = model.module.state_dict()
   else:
     state_dict = model.state_dict()
-  torch.save({'model': state_dict,
-              'iteration': iteration,
-              'optimizer': optimizer.state_dict(),
-              'learning_rate': learning_rate}, checkpoint_path)
+  return {'model': state_dict,
+          'iteration': iteration,
+          'optimizer': optimizer.state_dict(),
+          'learning_rate': learning_rate}
+
+
+def save_checkpoint(model, optimizer, learning_rate, iteration, checkpoint_path, worker=None):
+  """With a BackgroundWorker, state is snapshotted to the CPU here and torch.save runs on the worker thread"""
+  logger.info("Saving model and optimizer state at iteration {} to {}".format(
+    iteration, checkpoint_path))
+  checkpoint = checkpoint_state(model, optimizer, learning_rate, iteration)
+  if worker is None:
+    torch.save(checkpoint, checkpoint_path)
+  else:
+    worker.submit(torch.save, to_cpu(checkpoint), checkpoint_path)
 
 
 def summarize(writer, global_step, scalars={}, histograms={}, images={}, audios={}, audio_sampling_rate=22050):
@@ -120,9 +185,100 @@ def summarize(writer, global_step, scalars={}, histograms={}, images={}, audios=
     writer.add_audio(k, v, global_step, audio_sampling_rate)
 
 
+class CheckpointManager:
+  """
+  Rotating checkpoints in model_dir, one file per net (e.g. G_{iteration}.pth and D_{iteration}.pth).
+
+  save() snapshots the state to the CPU; the files are written on the worker thread (if given) to a
+  temporary name and atomically renamed, so a crash never leaves a truncated checkpoint behind.
+  checkpoints.json lists the complete checkpoints, oldest first, so resuming needs no glob. The latest
+  keep_last checkpoints and the keep_best ones with the lowest metric are kept, older files are deleted.
+  Checkpoints adopted from before the index (legacy) are listed but never deleted.
+  """
+  def __init__(self, model_dir, keep_last=3, keep_best=1, worker=None):
+    self.model_dir = model_dir
+    self.keep_last = keep_last
+    self.keep_best = keep_best
+    self.worker = worker
+    self.index_path = os.path.join(model_dir, "checkpoints.json")
+    if os.path.exists(self.index_path):
+      with open(self.index_path) as f:
+        self.entries = json.load(f)
+    else:
+      self.entries = self._legacy_entries()
+
+  def _legacy_entries(self):
+    """Adopts G_*.pth/D_*.pth files written before the index existed, by epoch-based training:
+    their iteration is an epoch, not a global step"""
+    entries = []
+    for path in glob.glob(os.path.join(self.model_dir, "G_*.pth")):
+      name = os.path.basename(path)
+      iteration = int(name[len("G_"):-len(".pth")])
+      if os.path.exists(os.path.join(self.model_dir, "D_{}.pth".format(iteration))):
+        entries.append({"iteration": iteration, "metric": None, "legacy": True,
+                        "files": {"G": name, "D": "D_{}.pth".format(iteration)}})
+    return sorted(entries, key=lambda e: e["iteration"])
+
+  def latest(self):
+    """{net name: checkpoint path} of the most recent checkpoint, or None"""
+    if not self.entries:
+      return None
+    return {k: os.path.join(self.model_dir, v) for k, v in self.entries[-1]["files"].items()}
+
+  def latest_is_legacy(self):
+    """True if the most recent checkpoint was adopted from before the index, see _legacy_entries"""
+    return bool(self.entries) and self.entries[-1].get("legacy", False)
+
+  def save(self, iteration, nets, learning_rate, metric=None):
+    """nets: {name: (model, optimizer)}. metric ranks the checkpoint for keep_best, lower is better."""
+    logger.info("Saving model and optimizer state at iteration {} to {}".format(iteration, self.model_dir))
+    snapshot = {k: to_cpu(checkpoint_state(model, optimizer, learning_rate, iteration))
+                for k, (model, optimizer) in nets.items()}
+    if self.worker is None:
+      self._write(iteration, snapshot, metric)
+    else:
+      self.worker.submit(self._write, iteration, snapshot, metric)
+
+  def _write(self, iteration, snapshot, metric):
+    files = {}
+    for k, checkpoint in snapshot.items():
+      files[k] = "{}_{}.pth".format(k, iteration)
+      path = os.path.join(self.model_dir, files[k])
+      torch.save(checkpoint, path + ".tmp")
+      os.replace(path + ".tmp", path)
+    self.entries = [e for e in self.entries if e["iteration"] != iteration]
+    self.entries.append({"iteration": iteration, "metric": metric, "files": files})
+
+    legacy = [e for e in self.entries if e.get("legacy", False)]
+    current = [e for e in self.entries if not e.get("legacy", False)]
+    keep = set(e["iteration"] for e in current[-self.keep_last:]) if self.keep_last > 0 else set()
+    ranked = sorted((e for e in current if e["metric"] is not None), key=lambda e: e["metric"])
+    keep.update(e["iteration"] for e in ranked[:self.keep_best])
+    keep.update(e["iteration"] for e in legacy)
+    removed = [e for e in self.entries if e["iteration"] not in keep]
+    self.entries = [e for e in self.entries if e["iteration"] in keep]
+
+    # the index never points at a deleted file
+    with open(self.index_path + ".tmp", "w") as f:
+      json.dump(self.entries, f, indent=2)
+    os.replace(self.index_path + ".tmp", self.index_path)
+    for e in removed:
+      for name in e["files"].values():
+        path = os.path.join(self.model_dir, name)
+        if os.path.exists(path):
+          logger.info("Deleting old checkpoint {}".format(path))
+          os.remove(path)
+
+
+def summarize_spectrograms(writer, global_step, spectrograms={}, **kwargs):
+  """summarize() with the images rendered from spectrograms, for use on a BackgroundWorker"""
+  images = {k: plot_spectrogram_to_numpy(v) for k, v in spectrograms.items()}
+  summarize(writer, global_step, images=images, **kwargs)
+
+
 def latest_checkpoint_path(dir_path, regex="G_*.pth"):
   f_list = glob.glob(os.path.join(dir_path, regex))
-  f_list.sort(key=lambda f: int("".join(filter(str.isdigit, f))))
+  f_list.sort(key=lambda f: int("".join(filter(str.isdigit, os.path.basename(f)))))
   x = f_list[-1]
   print(x)
   return x